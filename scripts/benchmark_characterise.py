@@ -0,0 +1,64 @@
+import os
+import json
+import argparse
+
+from yaaade.characterise.benchmark import FakeSpiceInterface, benchmark_characterisation
+
+
+# small grid run when no devices file is given
+DEFAULT_DEVICES = { 'config'    :   {'simulator' : 'ngspice'},
+                    'nfet_01v8' :   {'w'    :   1,
+                                     'l'    :   [0.15, 0.5, 1.0],
+                                     'ids'  :   [1e-9, 1e-3, 4],
+                                     'vds'  :   [0, 1.8, 7],
+                                     'vbs'  :   [0, -0.6, 3],
+                                     'vdd'  :   1.8,
+                                     'type' :   'nmos'}}
+
+
+parser = argparse.ArgumentParser(description='Time each stage of the MOS characterisation')
+parser.add_argument('--devices', help='devices yaml file, a small built-in grid by default')
+parser.add_argument('--simulator', choices=['fake', 'ngspice'], default='fake', help='backend to characterise with')
+parser.add_argument('--step-delay', type=float, default=0.0, help='seconds each fake analysis step takes')
+parser.add_argument('--repeats', type=int, default=3, help='number of times to run the characterisation')
+parser.add_argument('--rundir', default='rundir/benchmark', help='directory for the LUTs written')
+parser.add_argument('--json', help='file to save the results to')
+args = parser.parse_args()
+
+
+# read in the device simulation parameters
+if args.devices:
+    import yaml
+    with open(args.devices) as file:
+        devices = yaml.full_load(file)
+else:
+    devices = DEFAULT_DEVICES
+
+# the benches live in the spice directory of the repository
+if args.simulator == 'fake':
+    interface = FakeSpiceInterface(netlist_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'spice'),
+                                    step_delay=args.step_delay)
+else:
+    from yaaade.spice.ngspice import NgSpiceInterface
+    interface = NgSpiceInterface(verbose=False)
+    interface.config['simulator']['silent'] = True
+
+interface.enable_timing()
+results = benchmark_characterisation(devices, interface, repeats=args.repeats, rundir=args.rundir)
+
+
+# report each repeat and keep the fastest
+for repeat, result in enumerate(results):
+    print('-'*60)
+    print('Repeat %d: %d points in %0.3fs, %0.1f points/s' % (repeat, result['points'], result['seconds'], result['points_per_second']))
+
+best = min(results, key=lambda _: _['seconds'])
+print('-'*60)
+print('%-16s %12s %10s %8s' % ('stage', 'seconds', 'calls', '%'))
+for name in sorted(best['stages'], key=lambda _: -best['stages'][_]['seconds']):
+    stage = best['stages'][name]
+    print('%-16s %12.4f %10d %8.1f' % (name, stage['seconds'], stage['calls'], 100*stage['fraction']))
+
+if args.json:
+    with open(args.json, 'w') as file:
+        json.dump({'simulator' : args.simulator, 'devices' : devices, 'results' : results}, file, indent=4)
@@ -0,0 +1,285 @@
+import os
+import re
+import time
+import copy
+import numpy as np
+
+from yaaade.characterise.mos import CharacteriseMos, lut_axes
+from yaaade.spice.generic import GenericSpiceInterface
+from yaaade.spice.results import SimulationData
+
+
+# engineering suffixes of spice numbers
+SPICE_SUFFIXES = {'t' : 1e12, 'g' : 1e9, 'meg' : 1e6, 'k' : 1e3, 'm' : 1e-3, 'u' : 1e-6, 'n' : 1e-9, 'p' : 1e-12, 'f' : 1e-15}
+
+
+def spice_number(text):
+    '''
+        Convert a spice number such as 1000Meg or 1.5u to a float
+    '''
+
+    match = re.match(r'([-+]?[0-9.]+(?:e[-+]?[0-9]+)?)(meg|[tgkmunpf])?', text.strip().lower())
+    assert match, 'Cannot read the number (%s)' % text
+
+    return float(match.group(1))*SPICE_SUFFIXES.get(match.group(2), 1.0)
+
+
+
+class FakeSpiceInterface(GenericSpiceInterface):
+    '''
+        Stand-in simulator backend for benchmarking without a simulator installed
+
+        The characterisation bench is read and edited as normal but the analyses
+        run by run_control_steps are evaluated from a simple EKV style model, so
+        everything except the simulator itself does its real work. A fixed delay
+        per step can be added to mimic the cost of the simulator.
+
+        The plots are numbered the way ngspice numbers them, from a counter which
+        destroy all does not reset and with two plots per noise analysis, so a
+        step reading a plot its analyses did not make fails as it would in
+        ngspice.
+    '''
+
+    def __init__(self, verbose=False, netlist_dir=None, step_delay=0.0):
+        '''
+            Instantiate the object
+        '''
+
+        super().__init__(verbose)
+
+        self.config['simulator'] = {'executable'    :   'fake',
+                                    'shared'        :   True,
+                                    'silent'        :   True,
+                                    'in_memory'     :   True}
+        self.config['verbose'] = verbose
+
+        # where to find the benches and how long a step should take
+        self.netlist_dir = netlist_dir
+        self.step_delay = step_delay
+
+        # the plots held and the counter their numbers come from
+        self.plots = {}
+        self.plot_number = 1
+
+
+    def read_netlist_file(self, netlist_path):
+        '''
+            Read in a netlist from file, relative to the netlist directory if given
+        '''
+
+        if self.netlist_dir and not os.path.isabs(netlist_path):
+            netlist_path = os.path.join(self.netlist_dir, netlist_path)
+
+        super().read_netlist_file(netlist_path)
+
+
+    def set_parameters(self, parameters):
+        '''
+            Set parameters inside the netlist
+        '''
+
+        for name, value in parameters:
+            self.simulation['netlist'].set_param(name, '%0.20g' % value)
+
+
+    def _operating_point(self, params, ids, vds):
+        '''
+            Return the op parameters of the model at the drain currents and drain voltages
+        '''
+
+        ut = 0.0259
+        n = 1.3
+        l = params['l']
+        w = params['w']
+
+        # inversion level sets the gm/id and the overdrive
+        ic = ids/(2*n*200e-6*w/l*ut**2)
+        vth = 0.45 + 0.1*(np.sqrt(0.7 + abs(params['vbs'])) - np.sqrt(0.7))
+        vov = 2*n*ut*np.log(np.expm1(np.sqrt(ic)) + 1e-300)
+        gm = ids/(n*ut)*2/(1 + np.sqrt(1 + 4*ic))
+        cgg = 8e-15*w*l*(0.2 + 0.6*ic/(1 + ic))*np.ones_like(vds)
+
+        return {'id'    :   ids*np.ones_like(vds),
+                'gm'    :   gm*np.ones_like(vds),
+                'gds'   :   ids*0.05/l/(1 + vds),
+                'gmbs'  :   0.2*gm*np.ones_like(vds),
+                'vth'   :   vth*np.ones_like(ids*vds),
+                'vdsat' :   np.maximum(vov, 4*ut)*np.ones_like(vds),
+                'cgg'   :   cgg,
+                'cgs'   :   0.65*cgg,
+                'cgd'   :   0.1*cgg,
+                'vg'    :   (vth + vov)*np.ones_like(vds)}
+
+
+    def _dc(self, command, params, signals):
+        '''
+            Evaluate a dc sweep of vctl, optionally nested inside a sweep of vds
+        '''
+
+        tokens = command.split()[1:]
+        sweeps = [tokens[i:i+4] for i in range(0, len(tokens), 4)]
+        values = [np.arange(spice_number(start), spice_number(stop) + 0.5*spice_number(step), spice_number(step)) for name, start, stop, step in sweeps]
+
+        vctl = values[0]
+        vds = values[1] if len(values) > 1 else np.array([params['vds']])
+
+        # the first sweep is the inner loop
+        vds, vctl = [_.ravel() for _ in np.meshgrid(vds, vctl, indexing='ij')]
+        op = self._operating_point(params, 10**vctl, vds)
+
+        columns = []
+        for signal in signals:
+            name = re.match(r'@.*\[(\w+)\]', signal)
+            columns.append(op[name.group(1)] if name else op['vg'])
+
+        return np.column_stack(columns)
+
+
+    def _noise(self, command, params, signals):
+        '''
+            Evaluate the output noise spectrum at the current bias
+        '''
+
+        tokens = command.split()
+        points, start, stop = spice_number(tokens[4]), spice_number(tokens[5]), spice_number(tokens[6])
+        frequency = np.logspace(np.log10(start), np.log10(stop), int(round(np.log10(stop/start)*points)) + 1)
+
+        gm = self._operating_point(params, 10**params['vctl'], np.array([params['vds']]))['gm'][0]
+        thermal = 4*1.38e-23*300*2/3/gm
+        corner = 1e5/params['l']
+
+        noise = {'frequency' : frequency, 'onoise_spectrum' : np.sqrt(thermal*(1 + (corner/frequency)**1.1))}
+
+        return np.column_stack([noise[_.lower()] for _ in signals])
+
+
+    def _new_plot(self, analysis, values):
+        '''
+            Add a plot named as ngspice would name it, returning the name
+        '''
+
+        while analysis + str(self.plot_number) in self.plots:
+            self.plot_number += 1
+
+        name = analysis + str(self.plot_number)
+        self.plots[name] = values
+
+        return name
+
+
+    def run_control_steps(self, steps, netlist=None):
+        '''
+            Evaluate a list of analysis steps against the model
+        '''
+
+        if netlist is None:
+            netlist = self.simulation['netlist']
+
+        # the bench is still written out so the file handling is timed
+        with self.stage('write'):
+            with open(self.temp_file('_steps.spice'), 'w') as f:
+                f.write(str(netlist))
+
+        # the bias of the bench, a unit width when the bench fixes it on the device
+        params = {'w' : 1.0}
+        for name in ['l', 'w', 'vbs', 'vds', 'vctl']:
+            if netlist.get_param(name) is not None:
+                params[name] = spice_number(netlist.get_param(name))
+
+        step_datasets = []
+        for commands, output, signals in steps:
+
+            with self.stage('simulate'):
+
+                step_plots = []
+                for command in commands:
+
+                    parameter = re.match(r'alter(?:param)?\s+(\w+)\s*(?:dc\s*)?=\s*(\S+)', command)
+                    if parameter:
+                        params[parameter.group(1).lower()] = spice_number(parameter.group(2))
+                    elif command.strip() == 'destroy all':
+                        self.plots = {}
+                    elif command.startswith('dc '):
+                        step_plots.append(self._new_plot('dc', self._dc(command, params, signals)))
+                    elif command.startswith('noise '):
+                        step_plots.append(self._new_plot('noise', self._noise(command, params, signals)))
+                        step_plots.append(self._new_plot('noise', None))
+
+                if self.step_delay:
+                    time.sleep(self.step_delay)
+
+            # the first plot of the output analysis, as found by NgSpiceInterface.find_plot
+            plot_names = [_ for _ in step_plots if re.match(output + r'\d+$', _)]
+            assert plot_names, 'No plot found for the output (%s), the step made %s' % (output, step_plots)
+            assert self.plots[plot_names[0]] is not None, 'The signals (%s) cannot be found in the plot (%s)' % (signals, plot_names[0])
+
+            step_datasets.append(SimulationData(self.plots[plot_names[0]], [_.lower() for _ in signals]))
+
+        return step_datasets
+
+
+
+def benchmark_characterisation(config, interface=None, repeats=1, rundir='rundir/benchmark'):
+    '''
+        Time the characterisation of the devices in a config
+
+        The config takes the same form as for CharacteriseMos.measure_mos_op and
+        each device is characterised from scratch in this process, by default on
+        the stand-in backend. Every repeat returns a dictionary of:
+            points              :   number of (corner, temp, l, vds, vbs, id) points
+            seconds             :   wall clock time of the repeat
+            points_per_second   :   throughput
+            stages              :   seconds, calls and fraction of each stage
+
+        with the time outside the recorded stages given as the 'other' stage.
+    '''
+
+    if interface is None:
+        interface = FakeSpiceInterface()
+
+    timer = interface.config['timer'] or interface.enable_timing()
+    characterise_mos = CharacteriseMos(interface)
+
+    sim_config = config['config']
+    devices = copy.deepcopy(config)
+    del devices['config']
+    for device in devices:
+        devices[device].setdefault('temp', sim_config.get('temperature', 27))
+        devices[device].setdefault('corner', sim_config.get('corner', 'tt'))
+
+    results = []
+    for repeat in range(repeats):
+
+        timer.reset()
+        points = 0
+        start = time.perf_counter()
+
+        for device in devices:
+
+            axes = lut_axes(devices[device]['l'], devices[device]['ids'], devices[device]['vds'], devices[device]['vbs'],
+                            devices[device]['temp'], devices[device]['corner'])
+            points += int(np.prod([len(_) for _ in axes.values()]))
+
+            characterise_mos._measure_individual_mos_op(device,
+                                                        sim_config,
+                                                        devices[device]['w'],
+                                                        devices[device]['l'],
+                                                        ids=devices[device]['ids'],
+                                                        vds=devices[device]['vds'],
+                                                        vbs=devices[device]['vbs'],
+                                                        vdd=devices[device]['vdd'],
+                                                        type=devices[device]['type'],
+                                                        temp=devices[device]['temp'],
+                                                        corner=devices[device]['corner'],
+                                                        path=os.path.join(rundir, device + '.hdf5'),
+                                                        resume=False)
+
+        seconds = time.perf_counter() - start
+        timer.add('other', max(seconds - sum(timer.seconds.values()), 0.0))
+
+        results.append({'points'            :   points,
+                        'seconds'           :   seconds,
+                        'points_per_second' :   points/seconds,
+                        'stages'            :   timer.report(seconds)})
+
+    return results
@@ -0,0 +1,401 @@
+import numpy as np
+
+from yaaade.characterise.lut import AXES, NON_PARAMETERS, _read_axis
+from yaaade.characterise.expression import compile_expression
+
+
+# axes of the LUT grid picked by the query conditions
+GRID_AXES = ['l', 'vds', 'vbs']
+
+# axes interpolated between, in the order of the LUT arrays
+INTERPOLATED_AXES = ['temp', 'l', 'vds', 'vbs', 'id']
+
+# axes spanning decades which are interpolated on a log scale
+LOG_AXES = ['l', 'id']
+
+# order of the polynomial fitted through the neighbouring grid points
+INTERPOLATION_ORDERS = {'linear' : 1, 'cubic' : 3}
+
+# number of query points interpolated together, bounds the memory used
+INTERPOLATION_BATCH = 4096
+
+
+class LutEngine():
+    '''
+        In-memory view of a LUT file for fast queries
+
+        The axis values are read once and each op parameter is loaded into a
+        NumPy array the first time it is used, after which every query is
+        answered from memory. The arrays are always (corner, temp, l, vds, vbs,
+        id), files from before the corner and temperature axes are given
+        single entry leading axes.
+    '''
+
+    def __init__(self, hdf_file):
+        '''
+            Read the axes of an open LUT file
+        '''
+
+        self.file = hdf_file
+        self.values = {}
+        self.log_values = {}
+        self.inverse_tables = {}
+
+        # files with corner and temperature axes
+        self.pvt = list(self.file.attrs.get('axes', [])) == AXES
+
+        if self.pvt:
+            self.axes = {key : _read_axis(self.file['axes'][key]) for key in self.file['axes']}
+            self.axes['corner'] = [str(_) for _ in self.axes['corner']]
+        else:
+            self.axes = {key : np.array(self.file['indexing'][key][()], dtype=float) for key in GRID_AXES}
+            self.axes['corner'] = []
+            self.axes['temp'] = np.array([])
+
+            # the drain current is forced so it is the same at every grid point
+            self.axes['id'] = self.get('id')[0, 0, 0, 0, 0]
+
+        # sorted copies of the axes for binary searches
+        self.sorted_axes = {}
+        for key in INTERPOLATED_AXES:
+            values = np.asarray(self.axes[key], dtype=float)
+            order = np.argsort(values, kind='stable')
+            self.sorted_axes[key] = (values[order], order)
+
+
+    def parameters(self):
+        '''
+            Return the names of the op parameters in the file
+        '''
+
+        return [_ for _ in self.file if _ not in NON_PARAMETERS]
+
+
+    def get(self, parameter):
+        '''
+            Return the (corner, temp, l, vds, vbs, id) array of an op parameter
+
+            Expressions such as gm/id, id/w or gm/(2*pi*cgg) (see Expression)
+            are calculated over the whole LUT and kept like the op parameters,
+            w being the device width.
+        '''
+
+        if parameter not in self.values:
+
+            if parameter == 'w':
+                values = np.array(self.file['w'][()], dtype=float)
+
+            elif parameter in self.file:
+                values = self.file[parameter][()]
+                if not self.pvt:
+                    values = values[None, None]
+
+            else:
+                expression = compile_expression(parameter)
+                assert not expression.is_field, 'Parameter (%s) not in the LUT, the available parameters are %s' % (parameter, self.parameters())
+
+                values = expression.evaluate(self.get)
+
+            self.values[parameter] = values
+
+        return self.values[parameter]
+
+
+    def nearest(self, axis, values):
+        '''
+            Return the indices of the axis values closest to each of the values
+        '''
+
+        sorted_axis, order = self.sorted_axes[axis]
+        values = np.asarray(values, dtype=float)
+
+        if len(sorted_axis) == 1:
+            return np.zeros(values.shape, dtype=int)
+
+        # choose between the neighbours either side of each value
+        upper = np.clip(np.searchsorted(sorted_axis, values), 1, len(sorted_axis)-1)
+        lower = upper - 1
+        closest = np.where(values - sorted_axis[lower] <= sorted_axis[upper] - values, lower, upper)
+
+        return order[closest]
+
+
+    def pvt_indices(self, conditions):
+        '''
+            Return the corner and temperature indices of the conditions
+
+            The corner must match exactly and the closest temperature is used,
+            by default the first corner and temperature in the file. Files
+            without corner and temperature axes ignore them.
+        '''
+
+        if not self.pvt:
+            return (0, 0)
+
+        corner_i = 0
+        if 'corner' in conditions:
+            assert conditions['corner'] in self.axes['corner'], 'Corner (%s) not in the LUT, the available corners are %s' % (conditions['corner'], self.axes['corner'])
+            corner_i = self.axes['corner'].index(conditions['corner'])
+
+        temp_i = 0
+        if 'temp' in conditions:
+            temp_i = int(self.nearest('temp', conditions['temp']))
+
+        return (corner_i, temp_i)
+
+
+    def _broadcast(self, conditions, keys):
+        '''
+            Broadcast the conditions on the given axes together
+
+            Returns the shape of the conditions and a dictionary of each flattened.
+        '''
+
+        keys = [_ for _ in keys if _ in conditions and (self.pvt or _ != 'temp')]
+        arrays = np.broadcast_arrays(*[np.asarray(conditions[_], dtype=float) for _ in keys])
+        shape = arrays[0].shape if arrays else ()
+
+        return shape, dict(zip(keys, [_.ravel() for _ in arrays]))
+
+
+    def lookup(self, parameter, conditions):
+        '''
+            Return an op parameter at the grid points closest to the conditions
+
+            The temp, l, vds, vbs and id conditions can be values or arrays which
+            broadcast together, the result taking their shape. The id condition
+            picks the point of the sweep with the closest measured drain current,
+            without one the whole sweep is returned along a last axis. Axes
+            without a condition take their first value and the corner must match
+            exactly.
+        '''
+
+        # the closest drain current along each sweep
+        if 'id' in conditions:
+            return self.inverse(parameter, 'id', conditions['id'], conditions)
+
+        data = self.get(parameter)
+        corner_i = self.pvt_indices({'corner' : conditions['corner']} if 'corner' in conditions else {})[0]
+
+        shape, arrays = self._broadcast(conditions, INTERPOLATED_AXES)
+        size = int(np.prod(shape))
+
+        # the closest grid point on each axis
+        indices = [np.full(size, corner_i)]
+        for key in INTERPOLATED_AXES[:-1]:
+            indices.append(self.nearest(key, arrays[key]) if key in arrays else np.zeros(size, dtype=int))
+
+        values = data[tuple(indices)]
+
+        return values.reshape(shape + values.shape[1:])
+
+
+    def inverse_table(self, target, source):
+        '''
+            Return the table of a target parameter against a monotonic source parameter
+
+            Along the drain current sweep of every (corner, temp, l, vds, vbs)
+            slice the source is ordered to rise and any bumps are flattened so it
+            can be binary searched. The target is reordered to match and kept on
+            a log scale when it is positive across the LUT. Returns the source
+            and target tables as (slices x sweep) arrays and whether the target
+            is logarithmic.
+        '''
+
+        key = (target, source)
+        if key not in self.inverse_tables:
+
+            source_values = np.broadcast_to(self.get(source), self.get('id').shape)
+            target_values = np.broadcast_to(self.get(target), self.get('id').shape)
+            source_values = source_values.reshape(-1, source_values.shape[-1]).astype(float)
+            target_values = target_values.reshape(-1, target_values.shape[-1]).astype(float)
+
+            # turn the falling sweeps round
+            falling = source_values[:, -1] < source_values[:, 0]
+            source_values[falling] = source_values[falling, ::-1]
+            target_values[falling] = target_values[falling, ::-1]
+            source_values = np.fmax.accumulate(source_values, axis=-1)
+
+            logarithmic = np.nanmin(target_values) > 0
+            if logarithmic:
+                target_values = np.log(target_values)
+
+            self.inverse_tables[key] = (source_values, target_values, logarithmic)
+
+        return self.inverse_tables[key]
+
+
+    def inverse(self, target, source, values, conditions, method=None):
+        '''
+            Return a target parameter where the source parameter takes the values
+
+            For example the vgs giving a gm/id, the id/w of a gm/id or the gm at
+            an id. The values and the temp, l, vds and vbs conditions can be
+            arrays which broadcast together, the result taking their shape.
+
+            Each sweep is binary searched for the values in its inverse table
+            (see inverse_table). By default the closest grid point and closest
+            point of its sweep are used. With a method of 'linear' or 'cubic'
+            the target is interpolated along the sweep and between the slices
+            around the conditions as in interpolate.
+        '''
+
+        source_table, target_table, logarithmic = self.inverse_table(target, source)
+        corner_i = self.pvt_indices({'corner' : conditions['corner']} if 'corner' in conditions else {})[0]
+
+        shape, arrays = self._broadcast(dict(conditions, value=values), INTERPOLATED_AXES[:-1] + ['value'])
+        size = int(np.prod(shape))
+
+        # the slices around the conditions and their weights
+        stencils = []
+        for key in INTERPOLATED_AXES[:-1]:
+            if key not in arrays:
+                stencils.append((np.zeros((size, 1), dtype=int), np.ones((size, 1))))
+            elif method is None:
+                stencils.append((self.nearest(key, arrays[key])[:, None], np.ones((size, 1))))
+            else:
+                stencils.append(self.stencil(key, arrays[key], INTERPOLATION_ORDERS[method]))
+
+        grid_shape = self.get('id').shape[:-1]
+        points = source_table.shape[-1]
+
+        result = np.empty(size)
+        for start in range(0, size, INTERPOLATION_BATCH):
+            batch = slice(start, start+INTERPOLATION_BATCH)
+
+            # the row of the tables and weight of every slice in the stencil
+            indices = [np.full((min(size-start, INTERPOLATION_BATCH),) + (1,)*len(stencils), corner_i)]
+            weights = 1.0
+            for axis_i, (axis_indices, axis_weights) in enumerate(stencils):
+                expand = (slice(None),) + (None,)*axis_i + (slice(None),) + (None,)*(len(stencils)-axis_i-1)
+                indices.append(axis_indices[batch][expand])
+                weights = weights*axis_weights[batch][expand]
+            rows = np.ravel_multi_index(np.broadcast_arrays(*indices), grid_shape).reshape(len(indices[0]), -1)
+            weights = weights.reshape(rows.shape)
+            value = np.broadcast_to(arrays['value'][batch, None], rows.shape)
+
+            # binary search every sweep at once for the first point at or above the value
+            lower = np.zeros(rows.shape, dtype=int)
+            upper = np.full(rows.shape, points)
+            while np.any(lower < upper):
+                middle = (lower + upper)//2
+                below = source_table[rows, np.minimum(middle, points-1)] < value
+                searching = lower < upper
+                lower = np.where(searching & below, middle+1, lower)
+                upper = np.where(searching & ~below, middle, upper)
+            upper = np.clip(lower, 1, points-1)
+            lower = upper - 1
+
+            # position between the bracketing points of the sweep
+            source_lower = source_table[rows, lower]
+            source_upper = source_table[rows, upper]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fraction = np.clip((value - source_lower)/(source_upper - source_lower), 0, 1)
+            fraction = np.where(np.isfinite(fraction), fraction, 0.0)
+            if method is None:
+                fraction = np.round(fraction)
+
+            target_lower = target_table[rows, lower]
+            target_upper = target_table[rows, upper]
+            result[batch] = np.sum(weights*(target_lower + fraction*(target_upper - target_lower)), axis=-1)
+
+        result = result.reshape(shape)
+
+        return np.exp(result) if logarithmic else result
+
+
+    def stencil(self, axis, values, order=1):
+        '''
+            Return the grid indices and weights interpolating an axis at each of the values
+
+            A polynomial of the given order is fitted through the neighbouring
+            grid points, fewer where the axis is too short, and the values are
+            clamped to the ends of the axis. The length and drain current axes
+            are interpolated in decades. Returns (values x points) arrays of the
+            indices and weights.
+        '''
+
+        sorted_axis, axis_order = self.sorted_axes[axis]
+        values = np.asarray(values, dtype=float).ravel()
+        if axis in LOG_AXES:
+            sorted_axis = np.log10(sorted_axis)
+            values = np.log10(np.abs(values))
+        values = np.clip(values, sorted_axis[0], sorted_axis[-1])
+
+        # the points centred on each value, shifted inside the ends of the axis
+        points = min(order+1, len(sorted_axis))
+        start = np.clip(np.searchsorted(sorted_axis, values) - points//2, 0, len(sorted_axis)-points)
+        indices = start[:, None] + np.arange(points)
+
+        # lagrange weights of the points
+        nodes = sorted_axis[indices]
+        weights = np.ones(indices.shape)
+        for j in range(points):
+            for m in range(points):
+                if m != j:
+                    weights[:, j] *= (values - nodes[:, m])/(nodes[:, j] - nodes[:, m])
+
+        return axis_order[indices], weights
+
+
+    def interpolate(self, parameter, conditions, method='linear'):
+        '''
+            Interpolate an op parameter between the grid points around the conditions
+
+            The temp, l, vds, vbs and id conditions can be values or arrays which
+            broadcast together, the result taking their shape. Without an id
+            condition the whole drain current sweep is returned along a last
+            axis. Axes without a condition take their first value and the corner
+            must match exactly. The method is 'linear' (in decades of length and
+            drain current) or 'cubic'.
+
+            Parameters which are positive across the whole LUT (currents,
+            conductances, capacitances) mostly follow power laws of the drain
+            current, so they are interpolated on a log scale.
+        '''
+
+        assert method in INTERPOLATION_ORDERS, 'Interpolation method (%s) not in %s' % (method, list(INTERPOLATION_ORDERS))
+        order = INTERPOLATION_ORDERS[method]
+
+        # interpolate the log of positive parameters
+        if parameter not in self.log_values:
+            data = self.get(parameter)
+            self.log_values[parameter] = np.log(data) if np.nanmin(data) > 0 else None
+        logarithmic = self.log_values[parameter] is not None
+        data = self.log_values[parameter] if logarithmic else self.get(parameter)
+
+        corner_i = self.pvt_indices({'corner' : conditions['corner']} if 'corner' in conditions else {})[0]
+
+        # the conditions on the interpolated axes
+        shape, arrays = self._broadcast(conditions, INTERPOLATED_AXES)
+        size = int(np.prod(shape))
+
+        # the grid points and weights along each axis
+        stencils = []
+        for key in INTERPOLATED_AXES:
+            if key in arrays:
+                stencils.append(self.stencil(key, arrays[key], order))
+            elif key != 'id':
+                stencils.append((np.zeros((size, 1), dtype=int), np.ones((size, 1))))
+
+        values = np.empty((size,) + (() if 'id' in arrays else (data.shape[-1],)))
+        for start in range(0, size, INTERPOLATION_BATCH):
+            batch = slice(start, start+INTERPOLATION_BATCH)
+
+            # spread the indices and weights of each axis over their own dimension
+            indices = []
+            weights = 1.0
+            for axis_i, (axis_indices, axis_weights) in enumerate(stencils):
+                expand = (slice(None),) + (None,)*axis_i + (slice(None),) + (None,)*(len(stencils)-axis_i-1)
+                indices.append(axis_indices[batch][expand])
+                weights = weights*axis_weights[batch][expand]
+
+            points = data[(corner_i,) + tuple(indices)]
+            if 'id' in arrays:
+                values[batch] = np.sum(points*weights, axis=tuple(range(1, points.ndim)))
+            else:
+                values[batch] = np.sum(points*weights[..., None], axis=tuple(range(1, points.ndim-1)))
+
+        values = values.reshape(shape + values.shape[1:])
+
+        return np.exp(values) if logarithmic else values
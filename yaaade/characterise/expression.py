@@ -0,0 +1,142 @@
+import re
+import ast
+import warnings
+import functools
+import numpy as np
+
+
+# functions which can be called in an expression
+FUNCTIONS = {   'sqrt'  :   np.sqrt,
+                'log'   :   np.log,
+                'log10' :   np.log10,
+                'exp'   :   np.exp,
+                'abs'   :   np.abs,
+                'min'   :   np.minimum,
+                'max'   :   np.maximum}
+
+# named constants, any other name is an op parameter
+CONSTANTS = {'pi' : np.pi, 'e' : np.e}
+
+# arithmetic operators
+BINARY_OPERATORS = {ast.Add     :   np.add,
+                    ast.Sub     :   np.subtract,
+                    ast.Mult    :   np.multiply,
+                    ast.Div     :   np.true_divide,
+                    ast.Pow     :   np.power}
+
+UNARY_OPERATORS = {ast.USub : np.negative, ast.UAdd : np.positive}
+
+# the ratio syntax of the original queries, a/2*pi*b meaning a/(2*pi*b)
+LEGACY_RATIO = re.compile(r'\s*(\w+)\s*/\s*2\s*\*\s*pi\s*\*\s*(\w+)\s*')
+
+
+class Expression():
+    '''
+        Arithmetic expression of op parameters, ie. gm/id or gm/(2*pi*cgg)
+
+        The text is parsed once into a tree of NumPy operations so evaluating
+        it costs one array operation per node whatever the size of the arrays.
+        Expressions can use + - * / **, brackets, numbers, the constants pi and
+        e and the functions in FUNCTIONS, every other name is an op parameter.
+
+        Expressions are read with the usual operator precedence except for an
+        expression which is exactly a ratio of the original query syntax, a/2*pi*b,
+        which is still read as a/(2*pi*b) with a warning. Write (a/2)*pi*b for the
+        usual meaning.
+    '''
+
+    def __init__(self, text):
+        '''
+            Parse the expression
+        '''
+
+        self.text = text
+
+        # the old ratio syntax put the whole of 2*pi*x in the denominator
+        source = text
+        legacy = LEGACY_RATIO.fullmatch(text)
+        if legacy:
+            source = '%s/(2*pi*%s)' % legacy.groups()
+            warnings.warn('The expression (%s) is read as (%s) as in the original query syntax, write (%s/2)*pi*%s for the usual precedence' % ((text, source) + legacy.groups()))
+
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError:
+            raise AssertionError('Cannot read the expression (%s)' % text)
+
+        # the op parameters in the order they are first used
+        self.fields = []
+        self._evaluate = self._compile(tree.body)
+
+
+    @property
+    def is_field(self):
+        '''
+            True when the expression is a single op parameter
+        '''
+
+        return self.fields == [self.text.strip()]
+
+
+    def _compile(self, node):
+        '''
+            Return a function of the field lookup evaluating a node of the tree
+        '''
+
+        if isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPERATORS:
+            operator = BINARY_OPERATORS[type(node.op)]
+            left, right = self._compile(node.left), self._compile(node.right)
+            return lambda fetch: operator(left(fetch), right(fetch))
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            operator = UNARY_OPERATORS[type(node.op)]
+            operand = self._compile(node.operand)
+            return lambda fetch: operator(operand(fetch))
+
+        if isinstance(node, ast.Constant) and type(node.value) in [int, float]:
+            value = float(node.value)
+            return lambda fetch: value
+
+        if isinstance(node, ast.Name):
+            if node.id in CONSTANTS:
+                value = CONSTANTS[node.id]
+                return lambda fetch: value
+            if node.id not in self.fields:
+                self.fields.append(node.id)
+            name = node.id
+            return lambda fetch: fetch(name)
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            assert node.func.id in FUNCTIONS, 'Function (%s) in the expression (%s) not in %s' % (node.func.id, self.text, list(FUNCTIONS))
+            function = FUNCTIONS[node.func.id]
+            arguments = [self._compile(_) for _ in node.args]
+            return lambda fetch: function(*[_(fetch) for _ in arguments])
+
+        raise AssertionError('Cannot evaluate (%s) in the expression (%s)' % (ast.dump(node), self.text))
+
+
+    def evaluate(self, fetch):
+        '''
+            Evaluate the expression
+
+            fetch returns the values of an op parameter given its name, ie. the
+            __getitem__ of a dictionary of arrays. Each parameter is fetched once.
+        '''
+
+        values = {}
+        def fetch_once(name):
+            if name not in values:
+                values[name] = fetch(name)
+            return values[name]
+
+        return self._evaluate(fetch_once)
+
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(text):
+    '''
+        Return the parsed Expression of the text, each text is only parsed once
+    '''
+
+    return Expression(text)
@@ -0,0 +1,487 @@
+import os
+import json
+import h5py
+import hashlib
+import numpy as np
+
+
+# version of the LUT file layout, files without one are version 1
+LUT_FORMAT_VERSION = 2
+
+# order of the axes of every op parameter dataset
+AXES = ['corner', 'temp', 'l', 'vds', 'vbs', 'id']
+
+# axes indexing the planes written by the characterisation
+PLANE_AXES = ['corner', 'temp', 'l', 'vbs']
+
+# units of the axes and of the op parameters
+UNITS = {   'corner'        :   '',
+            'temp'          :   'C',
+            'l'             :   'um',
+            'w'             :   'um',
+            'vds'           :   'V',
+            'vbs'           :   'V',
+            'vgs'           :   'V',
+            'id'            :   'A',
+            'gm'            :   'S',
+            'gds'           :   'S',
+            'gmbs'          :   'S',
+            'vth'           :   'V',
+            'vdsat'         :   'V',
+            'cgg'           :   'F',
+            'cgs'           :   'F',
+            'cgd'           :   'F',
+            'noise_corner'  :   'Hz',
+            'noise_slope'   :   '',
+            'noise_thermal' :   'V/sqrt(Hz)'}
+
+# datasets of a LUT file which aren't op parameters
+NON_PARAMETERS = ['w', 'indexing', 'axes', 'complete']
+
+# compression of the op parameter datasets
+COMPRESSION = {'compression' : 'gzip', 'compression_opts' : 4, 'shuffle' : True}
+
+# bytes of measured planes held in memory before they are written
+WRITE_BUFFER = 16*2**20
+
+
+
+def model_digests(paths):
+    '''
+        Return the sha256 digest of each model file, used to record which models a LUT came from
+    '''
+
+    digests = {}
+    for path in paths:
+        if os.path.exists(path):
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            digests[path] = digest.hexdigest()
+        else:
+            digests[path] = 'missing'
+
+    return digests
+
+
+
+def bench_digest(bench, model_paths):
+    '''
+        Return the sha256 digest of a characterisation bench and the models it includes
+
+        LUTs record the digest so planes measured with a different bench or
+        models are not mixed with new ones when a run is resumed.
+    '''
+
+    digest = hashlib.sha256(bench.encode('utf8'))
+    for path, model_digest in sorted(model_digests(model_paths).items()):
+        digest.update(('\n%s %s' % (path, model_digest)).encode('utf8'))
+
+    return digest.hexdigest()
+
+
+
+def _chunks(shape):
+    '''
+        Return the chunk shape of an op parameter dataset
+
+        A chunk holds the (vds, id) plane at one (corner, temp, l, vbs), which is
+        both the unit the characterisation writes and a superset of the id sweep
+        read by a query at a fixed bias, so a query only decompresses one chunk.
+    '''
+
+    return (1, 1, 1, shape[3], 1, shape[5])
+
+
+
+def _read_axis(dataset):
+    '''
+        Read the values of an axis, decoding string axes
+    '''
+
+    values = dataset[()]
+    if values.dtype.kind in 'SO':
+        values = np.array([_.decode('ascii') if isinstance(_, bytes) else _ for _ in values])
+
+    return values
+
+
+
+def _same_axis(a, b):
+    '''
+        Check two axes hold the same values
+    '''
+
+    if len(a) != len(b):
+        return False
+    if np.asarray(a).dtype.kind in 'USO' or np.asarray(b).dtype.kind in 'USO':
+        return [str(_) for _ in a] == [str(_) for _ in b]
+
+    return bool(np.allclose(a, b))
+
+
+
+def _write_header(hdf_file, w, axes, metadata=None):
+    '''
+        Save the width, axis values and metadata of a LUT
+    '''
+
+    hdf_file.attrs['format_version'] = LUT_FORMAT_VERSION
+    hdf_file.attrs['axes'] = AXES
+    hdf_file.attrs['width'] = w
+
+    # free form metadata, dictionaries are stored as json
+    for key, value in (metadata or {}).items():
+        hdf_file.attrs[key] = json.dumps(value) if isinstance(value, dict) else value
+
+    # save the width used
+    hdf_file.create_dataset('w', data=w)
+    hdf_file['w'].attrs['units'] = UNITS['w']
+
+    # self describing axis values
+    axes_group = hdf_file.create_group('axes')
+    for key in AXES:
+        if key == 'corner':
+            axes_group.create_dataset(key, data=np.array([_.encode('ascii') for _ in axes[key]]))
+        else:
+            axes_group.create_dataset(key, data=axes[key])
+        axes_group[key].attrs['units'] = UNITS[key]
+
+    # save the indexing information read by QueryMos
+    indexing_group = hdf_file.create_group('indexing')
+    indexing = [['order', ['vbs', 'vds', 'l']], ['vbs', axes['vbs']], ['vds', axes['vds']], ['l', axes['l']]]
+    for index in indexing:
+
+        if isinstance(index[1][0], str):
+            ascii_list = [_.encode("ascii", "ignore") for _ in index[1]]
+            indexing_group.create_dataset(index[0], (len(ascii_list),1),'S10', ascii_list)
+        else:
+            indexing_group.create_dataset(index[0], data=index[1])
+
+
+
+def _create_parameter(hdf_file, key, shape, data=None, dtype=np.float64):
+    '''
+        Create a chunked and compressed op parameter dataset
+
+        The dataset is preallocated and filled with nan when no data is given.
+    '''
+
+    if data is None:
+        dataset = hdf_file.create_dataset(key, shape=shape, maxshape=(None,)*len(shape), dtype=dtype,
+                                            fillvalue=np.nan, chunks=_chunks(shape), **COMPRESSION)
+    else:
+        dataset = hdf_file.create_dataset(key, data=data, maxshape=(None,)*len(shape), dtype=dtype,
+                                            chunks=_chunks(shape), **COMPRESSION)
+
+    dataset.attrs['axes'] = AXES
+    dataset.attrs['units'] = UNITS.get(key, '')
+
+    return dataset
+
+
+
+def _read_completion(path, w, axes, digest=None):
+    '''
+        Return the completion bitmap of a LUT file matching the given grid
+
+        None is returned when the file doesn't exist or was made for a different
+        width or grid, or with a digest given for a different bench or models
+        (see bench_digest), in which case it can't be resumed.
+    '''
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with h5py.File(path, 'r') as hdf_file:
+
+            if 'complete' not in hdf_file or 'axes' not in hdf_file:
+                return None
+            if list(hdf_file.attrs.get('axes', [])) != AXES:
+                return None
+            if not np.all(hdf_file['w'][()] == w):
+                return None
+            if digest is not None and hdf_file.attrs.get('bench_digest') != digest:
+                return None
+            for key in AXES:
+                if not _same_axis(_read_axis(hdf_file['axes'][key]), axes[key]):
+                    return None
+
+            return hdf_file['complete'][()]
+
+    # a file left truncated by a crash is started again
+    except OSError:
+        return None
+
+
+
+def is_lut_complete(path, w, axes, digest=None):
+    '''
+        Check whether a LUT file holds every point of the given grid, measured with the bench digest if given
+    '''
+
+    complete = _read_completion(path, w, axes, digest)
+
+    return complete is not None and bool(np.all(complete))
+
+
+
+class LutWriter():
+    '''
+        Incremental writer of a LUT file that can be resumed
+
+        The (vds, id) planes at each (corner, temp, l, vbs) are written to the
+        file as soon as they are measured and marked in a completion bitmap. When
+        an interrupted characterisation is run again on the same grid only the
+        planes missing from the bitmap need to be measured.
+
+        The axes are given as a dictionary of the values of each of AXES.
+
+        Measured planes are held in memory until they take up buffer_size bytes
+        and are then written together, so the memory used is bounded by the
+        buffer rather than the size of the grid. Planes still in the buffer
+        when a run is interrupted are measured again on resume. The op
+        parameters can be stored as float32 to halve the size of the file.
+
+        The digest of the bench and models (see bench_digest) is stored in the
+        header and a file written with a different digest is started again
+        rather than resumed.
+    '''
+
+    def __init__(self, path, w, axes, resume=True, metadata=None, buffer_size=WRITE_BUFFER, dtype=np.float64, digest=None):
+        '''
+            Open an existing LUT of the same grid and digest or start a new one
+        '''
+
+        self.path = path
+        self.shape = tuple([len(axes[_]) for _ in AXES])
+        self.dtype = np.dtype(dtype)
+
+        # planes waiting to be written
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered_bytes = 0
+
+        # check if the output folder exists
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        complete = _read_completion(path, w, axes, digest) if resume else None
+
+        if complete is not None:
+            self.file = h5py.File(path, 'a')
+
+        else:
+            self.file = h5py.File(path, 'w')
+            _write_header(self.file, w, axes, dict(metadata or {}, **({'bench_digest' : digest} if digest else {})))
+            self.file.create_dataset('complete', data=np.zeros([len(axes[_]) for _ in PLANE_AXES], dtype=bool), maxshape=(None,)*len(PLANE_AXES))
+            self.file.flush()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *_):
+        self.close()
+
+
+    def close(self):
+        '''
+            Write the buffered planes and close the file
+        '''
+
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+
+
+    def missing(self, corner_i, temp_i):
+        '''
+            Return the (l, vbs) indices of the planes still to measure at a corner and temperature
+        '''
+
+        buffered = set([index[2:] for index, plane_values in self.buffer if index[:2] == (corner_i, temp_i)])
+
+        return [(int(l_i), int(vbs_i)) for l_i, vbs_i in np.argwhere(~self.file['complete'][corner_i, temp_i]) if (l_i, vbs_i) not in buffered]
+
+
+    def write_plane(self, index, plane_values):
+        '''
+            Store the (vds, id) arrays of each op parameter at one (corner, temp, l, vbs) index
+
+            The plane is buffered and only written once the buffer is full.
+        '''
+
+        plane_values = {key : np.asarray(values, dtype=self.dtype) for key, values in plane_values.items()}
+
+        self.buffer.append((tuple(index), plane_values))
+        self.buffered_bytes += sum([_.nbytes for _ in plane_values.values()])
+
+        if self.buffered_bytes >= self.buffer_size:
+            self.flush()
+
+
+    def flush(self):
+        '''
+            Write the buffered planes to the file and mark them complete
+        '''
+
+        if not self.buffer:
+            return
+
+        for (corner_i, temp_i, l_i, vbs_i), plane_values in self.buffer:
+            for key, values in plane_values.items():
+
+                # datasets are resizable so the grid can grow later
+                if key not in self.file:
+                    _create_parameter(self.file, key, self.shape, dtype=self.dtype)
+
+                self.file[key][corner_i, temp_i, l_i, :, vbs_i, :] = values
+
+        # only mark the planes once their data is safely on disk
+        self.file.flush()
+        for (corner_i, temp_i, l_i, vbs_i), plane_values in self.buffer:
+            self.file['complete'][corner_i, temp_i, l_i, vbs_i] = True
+        self.file.flush()
+
+        self.buffer = []
+        self.buffered_bytes = 0
+
+
+
+def write_lut(path, op_values, w, axes, metadata=None, dtype=None):
+    '''
+        Write the operating point data of a device to a LUT file
+
+        Each op parameter is stored as a (corner, temp, l, vds, vbs, id) array with
+        the axis values kept in the axes group and the indexing group read by
+        QueryMos. The arrays keep their own type unless a dtype is given.
+    '''
+
+    # check if the output folder exists
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    # write to a temporary file first so a partial LUT is never read
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with h5py.File(temp_path, 'w') as hdf_file:
+
+        for key, values in op_values.items():
+            _create_parameter(hdf_file, key, values.shape, data=values, dtype=dtype or values.dtype)
+
+        _write_header(hdf_file, w, axes, metadata)
+
+        # every point of the LUT is present
+        hdf_file.create_dataset('complete', data=np.ones([len(axes[_]) for _ in PLANE_AXES], dtype=bool), maxshape=(None,)*len(PLANE_AXES))
+
+    os.replace(temp_path, path)
+
+
+
+def read_lut_header(path):
+    '''
+        Read the width, axis values and metadata of a LUT file without its data
+    '''
+
+    with h5py.File(path, 'r') as hdf_file:
+
+        w = hdf_file['w'][()]
+        axes = {key : _read_axis(hdf_file['axes'][key]) for key in hdf_file['axes']}
+
+        metadata = {}
+        for key, value in hdf_file.attrs.items():
+            if key not in ['format_version', 'axes', 'width']:
+                metadata[key] = json.loads(value) if isinstance(value, str) and value.startswith('{') else value
+
+    return w, axes, metadata
+
+
+
+def read_lut(path):
+    '''
+        Read a whole LUT file back into memory
+
+        Returns the op parameter arrays, the width, the axis values and the
+        metadata.
+    '''
+
+    w, axes, metadata = read_lut_header(path)
+
+    with h5py.File(path, 'r') as hdf_file:
+        op_values = {key : hdf_file[key][()] for key in hdf_file if key not in NON_PARAMETERS}
+
+    return op_values, w, axes, metadata
+
+
+
+def merge_luts(paths, path):
+    '''
+        Merge LUT slices characterised over different corners, temperatures and lengths
+
+        The slices must share the same width and vds/vbs/id axes. The merged
+        corners keep the order they first appear in while the temperatures and
+        lengths are sorted. The data is copied one (vds, vbs, id) block at a time
+        so the memory used doesn't depend on the number or size of the slices.
+    '''
+
+    headers = [read_lut_header(_) for _ in paths]
+    parameters = []
+    for slice_path in paths:
+        with h5py.File(slice_path, 'r') as hdf_file:
+            parameters.append({key : hdf_file[key].dtype for key in hdf_file if key not in NON_PARAMETERS})
+
+    # check the slices line up
+    w, axes, metadata = headers[0]
+    for (slice_w, slice_axes, slice_metadata), slice_parameters in zip(headers[1:], parameters[1:]):
+        assert np.all(slice_w == w), 'Cannot merge LUT slices of different widths'
+        for key in ['vds', 'vbs', 'id']:
+            assert _same_axis(slice_axes[key], axes[key]), 'Cannot merge LUT slices with different %s axes' % key
+        assert set(slice_parameters) == set(parameters[0]), 'Cannot merge LUT slices with different op parameters'
+
+    # the axes of the merged grid
+    merged_axes = dict(axes)
+    merged_axes['corner'] = []
+    for slice_w, slice_axes, slice_metadata in headers:
+        merged_axes['corner'] += [_ for _ in slice_axes['corner'] if _ not in merged_axes['corner']]
+    for key in ['temp', 'l']:
+        merged_axes[key] = np.unique(np.concatenate([_[1][key] for _ in headers]))
+
+    # check if the output folder exists
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    # write to a temporary file first so a partial LUT is never read
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with h5py.File(temp_path, 'w') as hdf_file:
+
+        _write_header(hdf_file, w, merged_axes, metadata)
+
+        shape = tuple([len(merged_axes[_]) for _ in AXES])
+        for key, dtype in parameters[0].items():
+            _create_parameter(hdf_file, key, shape, dtype=dtype)
+        complete = hdf_file.create_dataset('complete', data=np.zeros([len(merged_axes[_]) for _ in PLANE_AXES], dtype=bool),
+                                            maxshape=(None,)*len(PLANE_AXES))
+
+        # place each slice in the merged grid
+        for slice_path, (slice_w, slice_axes, slice_metadata) in zip(paths, headers):
+
+            corner_indices = [merged_axes['corner'].index(_) for _ in slice_axes['corner']]
+            temp_indices = np.searchsorted(merged_axes['temp'], slice_axes['temp'])
+            l_indices = np.searchsorted(merged_axes['l'], slice_axes['l'])
+
+            with h5py.File(slice_path, 'r') as slice_file:
+                for corner_i, merged_corner_i in enumerate(corner_indices):
+                    for temp_i, merged_temp_i in enumerate(temp_indices):
+                        for l_i, merged_l_i in enumerate(l_indices):
+                            for key in parameters[0]:
+                                hdf_file[key][merged_corner_i, merged_temp_i, merged_l_i] = slice_file[key][corner_i, temp_i, l_i]
+                            complete[merged_corner_i, merged_temp_i, merged_l_i] = slice_file['complete'][corner_i, temp_i, l_i]
+
+    os.replace(temp_path, path)
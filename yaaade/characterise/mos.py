@@ -2,11 +2,137 @@ import os
 import h5py
 import re
 import copy
+import shutil
+import json
 import numpy as np
+import multiprocessing
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+
+from yaaade.characterise.engine import LutEngine
+from yaaade.characterise.expression import compile_expression
+from yaaade.characterise.lut import LutWriter, WRITE_BUFFER, merge_luts, is_lut_complete, model_digests, bench_digest, read_lut_header
+from yaaade.measure import measure
+
+
+# operating point parameters saved when the config doesn't list them
+OP_PARAMS = ['id', 'gm', 'gds', 'gmbs', 'vth', 'vdsat', 'cgg', 'cgs', 'cgd']
+
+
+def lut_axes(l_list, ids, vds, vbs, temp=27, corner='tt'):
+    '''
+        Create the axes of a LUT
+
+        The vds, vbs and drain current sweeps are given as [start, stop, number]
+        with the drain current taking number points per decade. The temperature
+        and corner can each be a single value or a list.
+    '''
+
+    axes = {}
+    axes['corner'] = [corner] if isinstance(corner, str) else list(corner)
+    axes['temp'] = np.atleast_1d(np.array(temp, dtype=float))
+    axes['l'] = np.array(l_list, dtype=float)
+    axes['vds'] = np.linspace(vds[0], vds[1], vds[2])
+    axes['vbs'] = np.linspace(vbs[0], vbs[1], vbs[2])
+
+    # the drain current is swept logarithmically
+    axes['id'] = np.logspace(np.log10(abs(ids[0])), np.log10(abs(ids[1])), int(np.log10(ids[1]/ids[0])*ids[2]))
+
+    return axes
+
+
+
+def existing_grid(path, adaptive, digest=None):
+    '''
+        Return the vds and vbs axes of an existing LUT refined with the same adaptive settings
+
+        With a digest the LUT must also come from the same bench and models.
+    '''
+
+    if not os.path.exists(path):
+        return None
+
+    try:
+        w, axes, metadata = read_lut_header(path)
+    except (OSError, KeyError):
+        return None
+
+    # compare the settings as they come back from the file
+    if metadata.get('adaptive') != json.loads(json.dumps(adaptive)):
+        return None
+    if digest is not None and metadata.get('bench_digest') != digest:
+        return None
+
+    return {'vds' : axes['vds'], 'vbs' : axes['vbs']}
+
+
+
+def _measure_grid(interface_class, verbose, interface_config, sim_config, device, device_config):
+    '''
+        Refine the adaptive grid of a device inside a worker process
+    '''
+
+    # recreate the interface inside this process
+    interface = interface_class(verbose=verbose)
+    interface.config.update(copy.deepcopy(interface_config))
+
+    # isolate the temporary files of this worker
+    interface.config['rundir'] = os.path.join(interface_config['rundir'], 'worker_%d' % os.getpid())
+
+    axes = lut_axes(device_config['l'], device_config['ids'], device_config['vds'], device_config['vbs'],
+                    device_config['temp'], device_config['corner'])
+
+    return CharacteriseMos(interface).measure_adaptive_grid(device,
+                                                             sim_config,
+                                                             device_config['w'],
+                                                             device_config['l'],
+                                                             device_config['ids'],
+                                                             device_config['vds'],
+                                                             device_config['vbs'],
+                                                             device_config['type'],
+                                                             device_config['vdd'],
+                                                             axes['temp'][0],
+                                                             axes['corner'][0],
+                                                             device_config['adaptive'])
+
+
+
+def _measure_slice(interface_class, verbose, interface_config, sim_config, device, device_config, corner, temp, l, path, resume, grid):
+    '''
+        Characterise a single corner, temperature and length of a device inside a worker process
+
+        The slice is written to path and the directory holding it is the run
+        directory of the job, so the temporary files of each worker are kept
+        apart and an interrupted slice is found again on resume.
+    '''
+
+    # recreate the interface inside this process
+    interface = interface_class(verbose=verbose)
+    interface.config.update(copy.deepcopy(interface_config))
+
+    # isolate the temporary files of this job alongside its slice
+    interface.config['rundir'] = os.path.dirname(path)
+
+    CharacteriseMos(interface)._measure_individual_mos_op(device,
+                                                          sim_config,
+                                                          device_config['w'],
+                                                          [l],
+                                                          ids=device_config['ids'],
+                                                          vds=device_config['vds'],
+                                                          vbs=device_config['vbs'],
+                                                          vdd=device_config['vdd'],
+                                                          type=device_config['type'],
+                                                          temp=temp,
+                                                          corner=corner,
+                                                          path=path,
+                                                          resume=resume,
+                                                          adaptive=device_config.get('adaptive'),
+                                                          grid=grid)
+
+    return path
 
 
-from yaaade.measure.measure import Measure
 
 class CharacteriseMos():
     '''
@@ -19,11 +145,12 @@ class CharacteriseMos():
         self.spice_interface_obj = spice_interface_obj
 
 
-    def _measure_individual_mos_op(self, device, config, w, l_list, 
-                                    ids=[1e-9,1e-3,10], vds=[0,1.8,11], vbs=[0,1.8,11], vgs=[0,1.8,11], 
-                                    type='nmos', vdd=None, temp=27, corner='tt'):
+    def _load_bench(self, device, config, w, type, vdd, temp, corner):
         '''
-            Measure the operating point of an MOS
+            Load the characterisation bench for a device at a temperature and corner
+
+            The temperature and corner of the bench are left alone when None.
+            Returns the op parameters saved by the bench.
         '''
 
         # load the characterization bench
@@ -39,7 +166,7 @@ class CharacteriseMos():
                 self.spice_interface_obj.read_netlist_file('pmos_characterise.spice')
 
         # set the MOS name
-        self.spice_interface_obj.simulation['netlist'] = re.sub(r'(.*)!MOS(.*)', r'\1'+device+r'\2', self.spice_interface_obj.simulation['netlist'])
+        self.spice_interface_obj.simulation['netlist'].substitute(r'(.*)!MOS(.*)', r'\1'+device+r'\2')
 
         # add include information
         if 'include' in config:
@@ -47,14 +174,14 @@ class CharacteriseMos():
             save_string = ''
             for include_line in config['include']:
                 save_string += include_line + '\n'
-            self.spice_interface_obj.simulation['netlist'] = re.sub(r'// !CONFIG-INCLUDE', save_string, self.spice_interface_obj.simulation['netlist'])
+            self.spice_interface_obj.simulation['netlist'].substitute(r'// !CONFIG-INCLUDE', save_string)
 
 
         # set the temperature and corner
-        if 'temperature' in config:
+        if temp is not None:
             self.spice_interface_obj.set_temperature(temp)
-        if 'corner' in config:
-            self.spice_interface_obj.set_corner(corner)
+        if corner is not None:
+            assert self.spice_interface_obj.set_corner(corner), 'The bench of %s does not load a corner from sky130.lib.spice so the corner (%s) cannot be set' % (device, corner)
 
         # set the maximum supply voltage
         if vdd:
@@ -64,114 +191,508 @@ class CharacteriseMos():
         self.spice_interface_obj.set_parameters([['w', float(w)]])
 
         # define the list of op parameters
-        if 'save' in config:
-            op_params = config['save']
-            save_string = ''
-            for op_param in op_params:
-                save_string += '@M.XM.m' + device + '[' + op_param + '] '
-            self.spice_interface_obj.simulation['netlist'] = re.sub(r'SAVE_TO_BE_POPULATED', save_string, self.spice_interface_obj.simulation['netlist'])
+        op_params = config.get('save', OP_PARAMS)
+        save_string = ''
+        for op_param in op_params:
+            save_string += '@M.XM.m' + device + '[' + op_param + '] '
+        self.spice_interface_obj.simulation['netlist'].substitute(r'SAVE_TO_BE_POPULATED', save_string)
+
+        return op_params
+
+
+    def _bench_digest(self, device, config, w, type, vdd):
+        '''
+            Return the digest of the bench and models of a device, the same at every temperature and corner
+
+            None is returned when a model can't be found.
+        '''
+
+        self._load_bench(device, config, w, type, vdd, None, None)
+        include_files = self.spice_interface_obj.resolved_include_files()
+        if include_files is None:
+            return None
+
+        return bench_digest(str(self.spice_interface_obj.simulation['netlist']), include_files)
 
 
+    def _measure_individual_mos_op(self, device, config, w, l_list, 
+                                    ids=[1e-9,1e-3,10], vds=[0,1.8,11], vbs=[0,1.8,11], vgs=[0,1.8,11], 
+                                    type='nmos', vdd=None, temp=27, corner='tt', path=None, resume=True,
+                                    adaptive=None, grid=None):
+        '''
+            Measure the operating point of an MOS
+
+            The temperature and corner can each be a single value or a list, every
+            combination is measured and stored as the leading axes of the LUT.
+
+            With adaptive settings (see _adapt_grid) the vds and vbs sweeps give the
+            coarse starting axes which are refined before the characterisation, the
+            refined axes can also be passed directly as a grid of {'vds', 'vbs'}.
+
+            The LUT is written to results/<device>.hdf5 unless a path is given.
+            With resume an existing LUT of the same grid, bench and models is
+            completed rather than measured again from the start, a LUT from a
+            different bench or models is measured again.
+
+            The planes are streamed to the LUT through a write buffer of
+            config['lut_buffer'] bytes and stored as config['lut_dtype'], float64
+            unless float32 is chosen.
+        '''
+
         # create the sweep values
-        vds_list = np.linspace(vds[0], vds[1], vds[2])
-        vbs_list = np.linspace(vbs[0], vbs[1], vbs[2])
-        
-        # create drain current sweep
-        ids_list = np.logspace(np.log10(abs(ids[0])), np.log10(abs(vbs[1])), int(np.log10(ids[1]/ids[0])*ids[2]))
+        axes = lut_axes(l_list, ids, vds, vbs, temp, corner)
+
+        if path is None:
+            path = 'results/' + device + '.hdf5'
+
+        # planes are only resumed when measured with the same bench and models
+        with self.spice_interface_obj.stage('netlist'):
+            digest = self._bench_digest(device, config, w, type, vdd)
+
+        # without the models the LUT can't be shown to match them so it is measured again
+        resume = resume and digest is not None
+
+        # an adaptive grid is refined once and reused when resuming
+        if adaptive and grid is None:
+            assert config['simulator'] != 'spectre', 'Adaptive grids are only supported with ngspice'
+            if resume:
+                grid = existing_grid(path, adaptive, digest)
+            if grid is None:
+                grid = self.measure_adaptive_grid(device, config, w, l_list, ids, vds, vbs, type, vdd, axes['temp'][0], axes['corner'][0], adaptive)
+        if grid is not None:
+            axes['vds'] = np.array(grid['vds'], dtype=float)
+            axes['vbs'] = np.array(grid['vbs'], dtype=float)
+
+        # nothing to do if a previous run finished this LUT
+        if resume and is_lut_complete(path, w, axes, digest):
+            return
+
+        writer = None
+        try:
+            for corner_i, corner_value in enumerate(axes['corner']):
+                for temp_i, temp_value in enumerate(axes['temp']):
+
+                    # skip the corners and temperatures already complete
+                    if writer is not None and not writer.missing(corner_i, temp_i):
+                        continue
+
+                    with self.spice_interface_obj.stage('netlist'):
+                        op_params = self._load_bench(device, config, w, type, vdd, temp_value, corner_value)
+
+                    # open the LUT once the models used are known
+                    if writer is None:
+                        metadata = {'device'        :   device,
+                                    'simulator'     :   config['simulator'],
+                                    'model_hashes'  :   model_digests(self.spice_interface_obj.resolved_include_files() or
+                                                                      self.spice_interface_obj.simulation['netlist'].include_files())}
+                        if adaptive:
+                            metadata['adaptive'] = adaptive
+                        with self.spice_interface_obj.stage('hdf5'):
+                            writer = LutWriter(path, w, axes, resume=resume, metadata=metadata,
+                                                buffer_size=config.get('lut_buffer', WRITE_BUFFER),
+                                                dtype=config.get('lut_dtype', 'float64'),
+                                                digest=digest)
+                        if not writer.missing(corner_i, temp_i):
+                            continue
+
+                    # measure the planes missing from the LUT, writing each as it completes
+                    if config['simulator'] == 'spectre':
+                        self._measure_op_points(writer, (corner_i, temp_i), axes['l'], axes['vds'], axes['vbs'], axes['id'])
+                    else:
+                        self._measure_op_planes(writer, (corner_i, temp_i), device, op_params, axes['l'], axes['vds'], axes['vbs'], axes['id'])
 
+        finally:
+            if writer is not None:
+                with self.spice_interface_obj.stage('hdf5'):
+                    writer.close()
 
-        # run an initial simulation to find out how many drain current sweep values are present
-        self.spice_interface_obj.run_simulation(outputs=['op', 'noise'])
 
-        # prepopulate the results dictionary
-        num = len(ids_list)
-        op_values = {}
-        for param in self.spice_interface_obj.simulation_data['op']:
-            op_values[param] = np.zeros((len(l_list), len(vds_list), len(vbs_list), num))
-        op_values['noise_corner'] = np.zeros((len(l_list), len(vds_list), len(vbs_list), num))
-        op_values['noise_slope'] = np.zeros((len(l_list), len(vds_list), len(vbs_list), num))
-        op_values['noise_thermal'] = np.zeros((len(l_list), len(vds_list), len(vbs_list), num))
+    def measure_adaptive_grid(self, device, config, w, l_list, ids, vds, vbs, type, vdd, temp, corner, adaptive):
+        '''
+            Refine the vds and vbs axes of a device, returned as a grid of {'vds', 'vbs'}
+        '''
+
+        axes = lut_axes(l_list, ids, vds, vbs, temp, corner)
+        op_params = self._load_bench(device, config, w, type, vdd, temp, corner)
+
+        vds_list, vbs_list = self._adapt_grid(device, op_params, axes['l'], axes['vds'], axes['vbs'], axes['id'], adaptive)
+
+        # update user
+        if self.spice_interface_obj.config['verbose']:
+            print('Adaptive grid for %s: %d vds and %d vbs values' % (device, len(vds_list), len(vbs_list)))
+
+        return {'vds' : vds_list, 'vbs' : vbs_list}
+
+
+    def _measure_op_points(self, writer, pvt, l_list, vds_list, vbs_list, ids_list):
+        '''
+            Measure the operating points with one simulation per bias point
+        '''
 
         # loop through each parameter value
-        for l_i, l in enumerate(l_list):
-            for vbs_i, vbs in enumerate(vbs_list):
-                for vds_i, vds in enumerate(vds_list):
-                    for ids_i, ids in enumerate(ids_list):
+        for l_i, vbs_i in writer.missing(*pvt):
+
+            l = l_list[l_i]
+            vbs = vbs_list[vbs_i]
+
+            plane_values = {}
+            spectra = []
 
-                        # update user
-                        if self.spice_interface_obj.config['verbose']:
-                            print('-'*150)
-                            print('Beginning new OP setting')
+            for vds_i, vds in enumerate(vds_list):
+                for ids_i, ids in enumerate(ids_list):
 
-                        # modify the netlist
-                        parameters = [['vbs', vbs], ['vds', vds], ['l', l], ['ids', ids]]
+                    # update user
+                    if self.spice_interface_obj.config['verbose']:
+                        print('-'*150)
+                        print('Beginning new OP setting')
+
+                    # modify the netlist
+                    parameters = [['vbs', vbs], ['vds', vds], ['l', l], ['ids', ids]]
+                    with self.spice_interface_obj.stage('netlist'):
                         self.spice_interface_obj.set_parameters(parameters)
 
-                        # run the simulation
-                        # try:
+                    # run the simulation
+                    with self.spice_interface_obj.stage('simulate'):
                         self.spice_interface_obj.run_simulation(outputs=['op', 'noise'])
 
-                        # collect the op parameter values
-                        for op_param in self.spice_interface_obj.simulation_data['op']:
-    
-                            # save the sweep data to the dictionary
-                            op_values[op_param][l_i][vds_i][vbs_i][ids_i] = self.spice_interface_obj.simulation_data['op'][op_param]
+                    # collect the op parameter values
+                    for op_param in self.spice_interface_obj.simulation_data['op']:
+                        if op_param not in plane_values:
+                            plane_values[op_param] = np.zeros((len(vds_list), len(ids_list)))
+                        plane_values[op_param][vds_i, ids_i] = self.spice_interface_obj.simulation_data['op'][op_param][0]
+
+                    # keep the noise spectrum to fit with the rest of the plane
+                    frequency = self.spice_interface_obj.get_signal('frequency', dataset='noise')
+                    spectra.append(self.spice_interface_obj.get_signal('onoise_spectrum', dataset='noise'))
+
+            # fit the noise of every point of the plane at once
+            with self.spice_interface_obj.stage('noise_fit'):
+                fits = measure.measure_noise_array(frequency, np.array(spectra))
+            for name, values in zip(['noise_thermal', 'noise_corner', 'noise_slope'], fits):
+                plane_values[name] = values.reshape(len(vds_list), len(ids_list))
+
+            with self.spice_interface_obj.stage('hdf5'):
+                writer.write_plane(pvt + (l_i, vbs_i), plane_values)
+
+
+    def _simulate_planes(self, device, op_params, planes, vds_list, ids_list, noise=True):
+        '''
+            Simulate the (vds, id) planes at a list of (l, vbs) points in one session
+
+            The drain current is set by a behavioural source controlled by the
+            voltage on vctl (id = 10**vctl) so a dc sweep of Vctl covers the whole
+            drain current axis. An evenly spaced vds axis is swept in the same dc
+            analysis, otherwise there is one dc analysis per vds value. All the
+            planes and noise analyses run in one simulator session so the models
+            are only loaded once.
+
+            The noise analyses of a plane follow its dc sweeps with the bias of
+            each point changed by altering the Vds and Vctl sources, so the
+            circuit isn't set up again between points, and their spectra are
+            gathered into one (points x frequency) array for the noise fit.
+
+            Returns a dictionary of (vds, id) arrays for each plane.
+        '''
+
+        # take the analyses out of the bench to issue them from the session
+        with self.spice_interface_obj.stage('netlist'):
+            netlist = self.spice_interface_obj.simulation['netlist'].copy()
+            noise_command = netlist.lines[netlist.analyses['.noise'][0]].strip()[1:]
+            netlist.remove_analyses()
+            netlist.remove_controls()
+
+        # the device operating point vectors and the gate voltage found
+        signals = ['@m.xm.m%s[%s]' % (device.lower(), _) for _ in op_params] + ['v(vg)']
+        names = list(op_params) + ['vgs']
+
+        # the sweep steps of the dc analyses
+        vctl_list = np.log10(ids_list)
+        vctl_step = vctl_list[1]-vctl_list[0] if len(vctl_list) > 1 else 1.0
+        vctl_sweep = 'dc vctl %0.12g %0.12g %0.12g' % (vctl_list[0], vctl_list[-1], vctl_step)
+
+        vds_steps = np.diff(vds_list)
+        nested = len(vds_list) == 1 or np.allclose(vds_steps, vds_steps[0])
+        if nested:
+            vds_step = vds_steps[0] if len(vds_list) > 1 else 1.0
+            dc_commands = [[vctl_sweep + ' vds %0.12g %0.12g %0.12g' % (vds_list[0], vds_list[-1], vds_step)]]
+        else:
+            dc_commands = [['alterparam vds = %0.12g' % vds, 'reset', vctl_sweep] for vds in vds_list]
+
+        steps = []
+        for l, vbs in planes:
+
+            # the whole drain current and voltage plane
+            for commands in dc_commands:
+                steps.append((['destroy all', 'alterparam l = %0.12g' % l, 'alterparam vbs = %0.12g' % vbs, 'reset'] + commands,
+                                'dc', signals))
+
+            # a noise analysis for every point of the plane, the frequencies are only read once
+            if noise:
+                for point_i, (vds, vctl) in enumerate([(vds, vctl) for vds in vds_list for vctl in vctl_list]):
+                    steps.append((['destroy all', 'alter vds dc = %0.12g' % vds, 'alter vctl dc = %0.12g' % vctl, noise_command],
+                                    'noise', ['frequency', 'onoise_spectrum'] if point_i == 0 else ['onoise_spectrum']))
+
+        step_datasets = self.spice_interface_obj.run_control_steps(steps, netlist)
 
-                            # print('op_param, l_i, vds_i, vbs_i, ids_i, value', op_param, l_i, vds_i, vbs_i, ids_i, self.spice_interface_obj.simulation_data['op'][op_param])
+        # unpack the results of each plane
+        planes_values = []
+        steps_per_plane = len(dc_commands) + (len(vds_list)*len(vctl_list) if noise else 0)
+        for plane_i in range(len(planes)):
 
-                        # calculate the noise parameters
-                        frequency = self.spice_interface_obj.get_signal('frequency', dataset='noise')
-                        onoise = self.spice_interface_obj.get_signal('onoise_spectrum', dataset='noise')
-                        thermal, corner_frequency, flicker_factor = Measure.measure_noise(frequency, onoise)
-                        op_values['noise_corner'][l_i][vds_i][vbs_i][ids_i] = corner_frequency
-                        op_values['noise_slope'][l_i][vds_i][vbs_i][ids_i] = flicker_factor
-                        op_values['noise_thermal'][l_i][vds_i][vbs_i][ids_i] = thermal
+            plane_datasets = step_datasets[plane_i*steps_per_plane:(plane_i+1)*steps_per_plane]
 
-        # check if the output folder exists
-        if not os.path.exists('results'):
-            os.makedirs('results')
+            # the inner loop of the sweep is the drain current
+            with self.spice_interface_obj.stage('parse'):
+                plane_array = np.concatenate([_.columns([signal.lower() for signal in signals]).real for _ in plane_datasets[:len(dc_commands)]])
+                assert plane_array.shape[0] == len(vds_list)*len(ids_list), 'The dc sweep returned %d points rather than %d' % (plane_array.shape[0], len(vds_list)*len(ids_list))
+                plane_array = plane_array.reshape(len(vds_list), len(ids_list), len(signals))
+                plane_values = {name : plane_array[:, :, i] for i, name in enumerate(names)}
 
-        # save the data to file
-        hdf_file = h5py.File('results/' + device + '.hdf5', 'w')
-        for key, values in op_values.items():
-            # print('key, values', key, values)
-            hdf_file.create_dataset(key, data=values)
+            # fit the noise of every point of the plane at once
+            if noise:
+                with self.spice_interface_obj.stage('parse'):
+                    noise_datasets = plane_datasets[len(dc_commands):]
+                    frequency = noise_datasets[0]['frequency'].real
+                    spectra = np.empty((len(noise_datasets), len(frequency)))
+                    for point_i, noise_data in enumerate(noise_datasets):
+                        spectra[point_i] = noise_data['onoise_spectrum'].real
+                with self.spice_interface_obj.stage('noise_fit'):
+                    fits = measure.measure_noise_array(frequency, spectra)
+                for name, values in zip(['noise_thermal', 'noise_corner', 'noise_slope'], fits):
+                    plane_values[name] = values.reshape(len(vds_list), len(ids_list))
 
-        # save the width used
-        hdf_file.create_dataset('w', data=w)
+            planes_values.append(plane_values)
 
-        # save the indexing information
-        indexing_group = hdf_file.create_group('indexing')
-        indexing = [['order', ['vbs', 'vds', 'l']], ['vbs', vbs_list], ['vds', vds_list], ['l', l_list]]
-        for index in indexing:
+        return planes_values
 
-            if isinstance(index[1][0], str):
-                ascii_list = [_.encode("ascii", "ignore") for _ in index[1]]
-                indexing_group.create_dataset(index[0], (len(ascii_list),1),'S10', ascii_list)
-            else:   
-                indexing_group.create_dataset(index[0], data=index[1])
 
+    def _measure_op_planes(self, writer, pvt, device, op_params, l_list, vds_list, vbs_list, ids_list):
+        '''
+            Measure the operating points with whole (vds, id) planes per analysis
 
-    def measure_mos_op(self, config):
+            Each length is run in its own simulator session and written to the LUT
+            as soon as it completes.
+        '''
+
+        missing = writer.missing(*pvt)
+        for l_i, l in enumerate(l_list):
+
+            # skip lengths which are already complete
+            vbs_indices = [_[1] for _ in missing if _[0] == l_i]
+            if not vbs_indices:
+                continue
+
+            # update user
+            if self.spice_interface_obj.config['verbose']:
+                print('-'*150)
+                print('Measuring length %g' % l)
+
+            planes_values = self._simulate_planes(device, op_params, [(l, vbs_list[_]) for _ in vbs_indices], vds_list, ids_list)
+
+            with self.spice_interface_obj.stage('hdf5'):
+                for vbs_i, plane_values in zip(vbs_indices, planes_values):
+                    writer.write_plane(pvt + (l_i, vbs_i), plane_values)
+
+
+    def _adapt_grid(self, device, op_params, l_list, vds_list, vbs_list, ids_list, adaptive):
+        '''
+            Refine the vds and vbs axes where the device behaviour is non-linear
+
+            Starting from the coarse axes each interval is bisected and the op
+            parameters simulated at the midpoint. Where the chosen quantities
+            differ from the linear interpolation of the interval ends by more than
+            the tolerance both halves are refined further, otherwise the interval
+            is left alone. Only operating points are simulated, using the shortest
+            and longest lengths and the ends of the other axis, so the probing is
+            cheap compared with the full characterisation.
+
+            adaptive is a dictionary of:
+                tolerance   :   relative interpolation error allowed (0.02)
+                quantities  :   expressions checked (['gm/id', 'gds', 'cgg'])
+                max_points  :   maximum number of values along an axis (33)
+
+            Returns the refined vds and vbs axes.
+        '''
+
+        tolerance = adaptive.get('tolerance', 0.02)
+        quantities = adaptive.get('quantities', ['gm/id', 'gds', 'cgg'])
+        max_points = adaptive.get('max_points', 33)
+
+        probe_lengths = sorted(set([min(l_list), max(l_list)]))
+
+        expressions = [compile_expression(_) for _ in quantities]
+
+        def evaluate(plane_values):
+            return np.array([_.evaluate(plane_values.__getitem__) for _ in expressions])
+
+        # simulate the quantities along one axis, returned with that axis first and the quantities along
+        # the second axis of each point
+        def probe_vds(values):
+            planes = [(l, vbs) for l in probe_lengths for vbs in [vbs_list[0], vbs_list[-1]]]
+            planes_values = self._simulate_planes(device, op_params, planes, values, ids_list, noise=False)
+            return np.moveaxis(np.array([evaluate(_) for _ in planes_values]), 2, 0)
+
+        def probe_vbs(values):
+            planes = [(l, vbs) for vbs in values for l in probe_lengths]
+            planes_values = self._simulate_planes(device, op_params, planes, [vds_list[0], vds_list[-1]], ids_list, noise=False)
+            data = np.array([evaluate(_) for _ in planes_values])
+            return data.reshape((len(values), len(probe_lengths)) + data.shape[1:])
+
+        def refine(values, probe):
+
+            values = list(values)
+            data = list(probe(values))
+            intervals = list(range(len(values)-1))
+
+            while intervals and len(values) < max_points:
+
+                # simulate the midpoints of the intervals still to check
+                midpoints = [0.5*(values[i]+values[i+1]) for i in intervals][:max_points-len(values)]
+                midpoint_data = probe(midpoints)
+
+                # compare them with the linear interpolation, relative to the size of each quantity
+                flagged = []
+                for i, midpoint, measured in zip(intervals, midpoints, midpoint_data):
+                    predicted = 0.5*(data[i]+data[i+1])
+                    floor = 1e-3*np.nanmax(np.abs(measured), axis=tuple([_ for _ in range(measured.ndim) if _ != 1]), keepdims=True)
+                    scale = np.maximum(np.abs(measured), floor)
+                    error = np.nanmax(np.abs(measured-predicted)/scale)
+                    flagged.append((midpoint, measured, error > tolerance))
+
+                # insert the midpoints, refining both halves of the inaccurate intervals
+                for midpoint, measured, inaccurate in flagged:
+                    i = int(np.searchsorted(values, midpoint))
+                    values.insert(i, midpoint)
+                    data.insert(i, measured)
+                intervals = [values.index(midpoint)+offset for midpoint, measured, inaccurate in flagged if inaccurate for offset in [-1, 0]]
+
+            return np.array(values)
+
+        return refine(vds_list, probe_vds), refine(vbs_list, probe_vbs)
+
+
+    def measure_mos_op(self, config, workers=None, resume=True):
         '''
             Measure the operating point of an MOS
+
+            Every device, corner, temperature and length is characterised as a
+            separate job across a pool of worker processes, one per core by
+            default. Each job writes a LUT slice into its own run directory,
+            <rundir>/slices/<slice>, which are then merged into
+            results/<device>.hdf5 with the corners and temperatures as axes.
+            Setting workers to 1 runs the devices one after another in this process.
+
+            The temperatures and corners are taken from the 'temp' and 'corner'
+            entries of each device, falling back to the 'temperature' and 'corner'
+            entries of the config and then to 27C and the tt corner.
+
+            Devices with an 'adaptive' entry have their vds and vbs axes refined
+            first (see _adapt_grid), all the slices of the device then share the
+            refined axes.
+
+            With resume the finished LUTs are skipped and interrupted slices only
+            measure the planes they are missing, as long as the bench and models
+            can be found and are unchanged (see bench_digest).
         '''
 
         sim_config = config['config']
         devices    = copy.deepcopy(config)
         del devices['config']
 
+        # the process, voltage and temperature grid of each device
+        for device in devices:
+            devices[device].setdefault('temp', sim_config.get('temperature', 27))
+            devices[device].setdefault('corner', sim_config.get('corner', 'tt'))
+
+        # characterise everything here
+        if workers == 1:
+            for device in devices:
+                print('length width: ', devices[device]['l'])
+                self._measure_individual_mos_op(device,
+                                                sim_config,
+                                                devices[device]['w'], 
+                                                devices[device]['l'], 
+                                                ids=devices[device]['ids'],
+                                                vds=devices[device]['vds'],
+                                                vbs=devices[device]['vbs'],
+                                                vdd=devices[device]['vdd'],
+                                                type=devices[device]['type'],
+                                                temp=devices[device]['temp'],
+                                                corner=devices[device]['corner'],
+                                                resume=resume,
+                                                adaptive=devices[device].get('adaptive'))
+            return
+
+        # default to one worker per core
+        if not workers:
+            workers = os.cpu_count()
+
+        interface = self.spice_interface_obj
+
+        # the finished LUTs are only reused when measured with the same bench and models
+        digests = {}
+        if resume:
+            for device in devices:
+                digests[device] = self._bench_digest(device, sim_config, devices[device]['w'], devices[device]['type'], devices[device]['vdd'])
+
+        # the shared simulator library is not fork safe so always spawn fresh processes
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+
+            # refine the adaptive grids first as every slice of a device must share them
+            grids = {}
+            for device in devices:
+                if devices[device].get('adaptive') and resume and digests[device] is not None:
+                    grids[device] = existing_grid('results/' + device + '.hdf5', devices[device]['adaptive'], digests[device])
+            grid_devices = [_ for _ in devices if devices[_].get('adaptive') and grids.get(_) is None]
+            grids.update(zip(grid_devices, executor.map(_measure_grid,
+                                                        [type(interface)]*len(grid_devices),
+                                                        [interface.config['verbose']]*len(grid_devices),
+                                                        [interface.config]*len(grid_devices),
+                                                        [sim_config]*len(grid_devices),
+                                                        grid_devices,
+                                                        [devices[_] for _ in grid_devices])))
+
+            # shard the work by device, corner, temperature and length
+            jobs = []
+            for device in devices:
+
+                # the merged LUT holds the temperatures and lengths sorted
+                axes = lut_axes(devices[device]['l'], devices[device]['ids'], devices[device]['vds'], devices[device]['vbs'],
+                                devices[device]['temp'], devices[device]['corner'])
+                axes['temp'] = np.unique(axes['temp'])
+                axes['l'] = np.unique(axes['l'])
+                if grids.get(device) is not None:
+                    axes['vds'] = np.array(grids[device]['vds'], dtype=float)
+                    axes['vbs'] = np.array(grids[device]['vbs'], dtype=float)
+
+                # skip the devices finished by a previous run
+                if resume and digests[device] is not None and is_lut_complete('results/' + device + '.hdf5', devices[device]['w'], axes, digests[device]):
+                    continue
+
+                for corner in axes['corner']:
+                    for temp_i, temp in enumerate(axes['temp']):
+                        for l_i, l in enumerate(axes['l']):
+                            slice_dir = os.path.join(interface.config['rundir'], 'slices', '%s_%s_t%d_l%d' % (device, corner, temp_i, l_i))
+                            jobs.append((device, devices[device], corner, temp, l, os.path.join(slice_dir, 'lut.hdf5')))
+
+            slice_paths = list(executor.map(_measure_slice,
+                                            [type(interface)]*len(jobs),
+                                            [interface.config['verbose']]*len(jobs),
+                                            [interface.config]*len(jobs),
+                                            [sim_config]*len(jobs),
+                                            *zip(*jobs),
+                                            [resume]*len(jobs),
+                                            [grids.get(_[0]) for _ in jobs]))
+
+        # merge the slices of each device into its LUT
         for device in devices:
-            print('length width: ', devices[device]['l'])
-            self._measure_individual_mos_op(device,
-                                            sim_config,
-                                            devices[device]['w'], 
-                                            devices[device]['l'], 
-                                            ids=devices[device]['ids'],
-                                            vds=devices[device]['vds'],
-                                            vbs=devices[device]['vbs'],
-                                            vdd=devices[device]['vdd'],
-                                            type=devices[device]['type'])
+            device_paths = [path for job, path in zip(jobs, slice_paths) if job[0] == device]
+            if not device_paths:
+                continue
+            merge_luts(device_paths, 'results/' + device + '.hdf5')
+            for path in device_paths:
+                shutil.rmtree(os.path.dirname(path))
 
 
 
@@ -180,14 +701,23 @@ class QueryMos():
 
     '''
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, interpolation=None):
         '''
             Setup the query object to retrieve characterisation info
+
+            By default queries take the closest grid point, an interpolation of
+            'linear' or 'cubic' interpolates between the grid points instead
+            (see LutEngine.interpolate).
         '''
 
+        self.interpolation = interpolation
+
         # load the characterisation bench
         self.file = h5py.File(filepath, 'r')
 
+        # the axes and op parameters are kept in memory for the queries
+        self.lut = LutEngine(self.file)
+
 
     def get_field_names(self):
         '''
@@ -220,7 +750,7 @@ class QueryMos():
         assert parameter in parameters, 'Parameter (%s) not in valid list. Use the get_parameter_names() to find suitable options' % parameter
 
         # return the data
-        return list( self.file['indexing'][parameter] )
+        return list( self.lut.axes[parameter] )
 
         # index = self.find_index(parameter)
         # print('index', index)
@@ -252,32 +782,27 @@ class QueryMos():
                 return i
 
 
-    def query_mos_op(self, parameter, conditions):
-        '''
-            Query the MOS operating point data
+    def find_pvt_indices(self, conditions):
         '''
+            Find the corner and temperature indices of the conditions
 
-        if '/' in parameter:
-            operands = parameter.split('/')
+            The corner must match exactly and the closest temperature is used,
+            by default the first corner and temperature in the file. Files
+            without corner and temperature axes always give the first indices.
+        '''
 
-            if operands[1].startswith('2*pi*'):
-                denominator = self.query_single_mos_op(operands[1][5:], conditions)
-                denominator = [_*2*np.pi for _ in denominator]
-            else:
-                denominator = self.query_single_mos_op(operands[1], conditions)
+        return self.lut.pvt_indices(conditions)
 
 
-            if operands[0] == '1':
-                numerator   = [1.0]*len(denominator)
-            else:
-                numerator   = self.query_single_mos_op(operands[0], conditions)
+    def query_mos_op(self, parameter, conditions):
+        '''
+            Query the MOS operating point data
 
-            values = [numerator[_]/denominator[_] for _ in range(len(numerator))]
-        
-        else:
-            values = self.query_single_mos_op(parameter, conditions)
+            The parameter can be an expression of op parameters such as gm/id,
+            gm/(2*pi*cgg) or sqrt(noise_thermal), see Expression.
+        '''
 
-        return values
+        return self.query_single_mos_op(parameter, conditions)
 
 
     def query_single_mos_op(self, parameter, conditions):
@@ -290,70 +815,60 @@ class QueryMos():
             assert 'f_hi' in conditions, 'Must provide frequency high value'
             return self.integrated_noise(conditions=conditions, f_hi=conditions['f_hi'])
 
-        # get the indexing data
-        indexing = {}
-        for key in list(self.file['indexing']):
-            indexing[key] = list(self.file['indexing'][key])
+        return self._query_array(parameter, conditions)[()]
 
-        # find the order of parameters in the LUT
-        parameters = self.get_parameter_names()
-        indices = [0,0,0,0]
-        for key in conditions:
-            if key in parameters:
-                index = self.find_index(key)
-                values = self.get_parameter_values(key)
-                
-                # find the closest index
-                difference = []
-                for i in range(len(values)):
-                    difference.append( abs(values[i] - conditions[key]) )
-                indices[index] = difference.index(min(difference))
-
-
-        # find the id index
-        if 'id' in conditions.keys():
-
-            temp_condition = copy.deepcopy(conditions)
-            del(temp_condition['id'])
-            id_list = self.query_mos_op('id', temp_condition)
-            difference = []
-            for id_i in id_list:
-                difference.append( abs(id_i - conditions['id'] ) )
-            indices[3] = difference.index(min(difference))
-
-            return self.file[parameter][indices[2]][indices[1]][indices[0]][indices[3]]
-        
-        else:
-            return self.file[parameter][indices[2]][indices[1]][indices[0]]
 
-        # # find the indexing for the data
-        # index_values = [0]*len(conditions)
-        # for condition in conditions:
-        #     index = self.find_index(condition)
-        #     index_values[index] = indexing[condition].index(conditions[condition])                
-        # return self.file[parameter][index_values[2]][index_values[1]][index_values[0]]
+    def _query_array(self, parameter, conditions, cache=None):
+        '''
+            Query a parameter or expression of parameters over arrays of conditions
 
+            Expressions are evaluated over the whole LUT once per file and then
+            looked up like the op parameters. The values of each parameter are
+            kept in the cache if one is given so they are only looked up once
+            between several queries.
+        '''
 
-    def collect_expression(self, expression, conditions):
+        if cache is None:
+            cache = {}
+
+        if parameter not in cache:
+
+            # interpolate between the grid points around the conditions
+            if self.interpolation:
+                cache[parameter] = self.lut.interpolate(parameter, conditions, self.interpolation)
+            else:
+                cache[parameter] = self.lut.lookup(parameter, conditions)
+
+        return cache[parameter]
+
+
+    def query_batch(self, parameters, conditions):
         '''
-            Dismantle an expression to return values
+            Query several MOS operating point parameters over arrays of conditions
+
+            The l, vds, vbs, id and temp conditions can be values, lists or arrays
+            which broadcast together, ie. arrays from np.meshgrid or with their
+            own axes to sweep a grid, and the corner a single value. Parameters
+            can be expressions as in query_mos_op.
+
+            Returns a dictionary of arrays of the shape of the conditions for each
+            parameter, with the drain current sweep along a last axis when there
+            is no id condition. A single parameter name returns its array.
         '''
-        
-        if '/' in expression:
-            operands = expression.split('/')
 
-            denominator = self.query_mos_op(operands[1], conditions)
-            if operands[0] == '1':
-                numerator   = [1.0]*len(denominator)
-            else:
-                numerator   = self.query_mos_op(operands[0], conditions)
+        cache = {}
+        if isinstance(parameters, str):
+            return self._query_array(parameters, conditions, cache)
 
-            values = [numerator[_]/denominator[_] for _ in range(len(numerator))]
-        
-        else:
-            values = self.query_mos_op(expression, conditions)
+        return {parameter : self._query_array(parameter, conditions, cache) for parameter in parameters}
+
+
+    def collect_expression(self, expression, conditions):
+        '''
+            Return the values of an expression of op parameters
+        '''
 
-        return values
+        return self.query_mos_op(expression, conditions)
 
 
     def plot(self, x, y, conditions, y_log=True, extra_plot_cmd=None):
@@ -364,23 +879,19 @@ class QueryMos():
         if any([type(conditions[_])==list for _ in conditions]):
             loop_conditions = np.where([type(conditions[_])==list for _ in conditions])[0]
             for loop_condition in loop_conditions:
-                for vary in conditions[list(conditions.keys())[loop_condition]]:
-
-                    # create a copy with a single value in the sweep
-                    temp_condition = copy.deepcopy(conditions)
-                    temp_condition[list(conditions.keys())[loop_condition]] = vary
 
-                    # get the results
-                    x_values = self.query_mos_op(x, temp_condition)
-                    y_values = self.query_mos_op(y, temp_condition)
+                # query every value of the sweep at once
+                key = list(conditions.keys())[loop_condition]
+                values = self.query_batch([x, y], dict(conditions, **{key : np.array(conditions[key])}))
 
-                    # now plot the results
+                # now plot the results
+                for x_values, y_values in zip(values[x], values[y]):
                     if y_log:
                         plt.semilogy(x_values, y_values)
                     else:
                         plt.plot(x_values, y_values)
 
-                legend = conditions[list(conditions.keys())[loop_condition]]
+                legend = conditions[key]
 
         else:
 
@@ -416,9 +927,10 @@ class QueryMos():
         def noise_calc(conditions):
 
             # collect noise information
-            noise_corner  = self.query_mos_op('noise_corner',  conditions)
-            noise_slope   = self.query_mos_op('noise_slope',   conditions)
-            noise_thermal = self.query_mos_op('noise_thermal', conditions)
+            values = self.query_batch(['noise_corner', 'noise_slope', 'noise_thermal'], conditions)
+            noise_corner  = values['noise_corner']
+            noise_slope   = values['noise_slope']
+            noise_thermal = values['noise_thermal']
 
             ## calculate integrated noise
             
@@ -432,30 +944,20 @@ class QueryMos():
 
             return noise
 
-        noise = []
-        if any([type(conditions[_])==list for _ in conditions]):
-            loop_conditions = np.where([type(conditions[_])==list for _ in conditions])[0]
-            for loop_condition in loop_conditions:
-                for vary in conditions[list(conditions.keys())[loop_condition]]:
-
-                    # create a copy with a single value in the sweep
-                    temp_condition = copy.deepcopy(conditions)
-                    temp_condition[list(conditions.keys())[loop_condition]] = vary
-                    
-                    # calculate noise
-                    noise.append(noise_calc(temp_condition))       
-        else:
-            return noise_calc(conditions)
+        # lists of conditions are calculated together
+        conditions = {key : np.array(value) if type(value) == list else value for key, value in conditions.items()}
+
+        return noise_calc(conditions)
 
 
     def get_matching_value(self, original, matching, value, conditions):
         '''
             Given a given value in one parameter find the matching 
             value in another parameter
-        '''
 
-        original_list = self.query_mos_op(original, conditions=conditions)
-
-        closest_index = min(range(len(original_list)), key=lambda i: abs(original_list[i]-value))
+            The drain current sweep is binary searched in a precomputed inverse
+            table (see LutEngine.inverse) and interpolated with the interpolation
+            of the query object. The value and conditions can be arrays.
+        '''
 
-        return self.query_mos_op(matching, conditions=conditions)[closest_index]
\ No newline at end of file
+        return self.lut.inverse(matching, original, value, conditions, self.interpolation)[()]
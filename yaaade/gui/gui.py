@@ -34,22 +34,16 @@ class MainWindow(QtWidgets.QMainWindow):
 
         query_obj = QueryMos('../../__development/results/sky130_fd_pr__nfet_01v8.hdf5')
         l = query_obj.get_parameter_values('l')
-        for l_i in l:
-
-            conditions = {  'l'     :   l_i,
-                            'vbs'   :   0.00,
-                            'vds'   :   5.00}
-
-            id = [_ for _ in query_obj.query_mos_op('id', conditions)]
-            gm = [_ for _ in query_obj.query_mos_op('gm', conditions)]
-            gds = [_ for _ in query_obj.query_mos_op('gds', conditions)]
-            vgs = [_ for _ in query_obj.query_mos_op('vgs', conditions)]
-            vdsat = [_ for _ in query_obj.query_mos_op('vdsat', conditions)]
-            noise_thermal = [_ for _ in query_obj.query_mos_op('noise_thermal', conditions)]
-            noise_corner = [_ for _ in query_obj.query_mos_op('noise_corner', conditions)]
-
-        x = [gm[_]/id[_] for _ in range(len(gm))]
-        y = [gm[_]/gds[_] for _ in range(len(gm))]
+
+        # every length in one query, a row of values per length
+        conditions = {  'l'     :   l,
+                        'vbs'   :   0.00,
+                        'vds'   :   5.00}
+
+        values = query_obj.query_batch(['id', 'gm', 'gds', 'vgs', 'vdsat', 'noise_thermal', 'noise_corner', 'gm/id', 'gm/gds'], conditions)
+
+        x = values['gm/id'][-1]
+        y = values['gm/gds'][-1]
 
         p1.setData(x=x, y=y, pen=pg.mkPen('k', width=2))
 
@@ -9,7 +9,7 @@ def measure_max(object, signal):
     signal_value = object.get_signal(signal)
     sweep_value = object.get_swept_values()
     
-    return [sweep_value[signal_value.index(max(signal_value))], max(signal_value)]
+    return [sweep_value[np.argmax(signal_value)], max(signal_value)]
     
 
 
@@ -140,66 +140,105 @@ def measure_phase_gain_margin(object, node, alert=True, invert=False):
 
 
 
-def measure_noise(frequency=None, noise=None):
-# def measure_noise():
+def _fit_flicker_thermal(frequency, psd, slope):
     '''
-        Measure the corner frequency, slope factor of flicker noise and the thermal noise from simulation data 
+        Weighted least-squares fit of psd = thermal + flicker*(frequency/frequency[0])**-slope
+
+        The fit is linear in the thermal and flicker terms for a fixed slope so
+        they are solved in closed form for every spectrum at once. The residuals
+        are relative to the spectrum so every decade counts equally.
+
+        Returns the thermal and flicker terms and the residual of each spectrum.
     '''
 
-    # get the signals to measure
-    if not frequency.all():
-        frequency = object.get_signal('frequency', dataset='noise')
-    
-    if not noise.all():
-        noise = object.get_signal('onoise_spectrum', dataset='noise')
+    basis = (frequency/frequency[..., :1])**-slope
+    weight = 1/psd**2
 
-    length = len(frequency)
+    # normal equations of the two term fit
+    a11 = np.sum(weight, axis=-1)
+    a12 = np.sum(weight*basis, axis=-1)
+    a22 = np.sum(weight*basis**2, axis=-1)
+    b1 = np.sum(weight*psd, axis=-1)
+    b2 = np.sum(weight*basis*psd, axis=-1)
 
-    # create theoretical flicker noise
-    flicker_factor = 1.5
-    flicker = [float(noise[0])]
-    for i in range(1, length):
-        flicker.append( noise[0]/(np.sqrt(frequency[i]**flicker_factor) ) )
+    with np.errstate(divide='ignore', invalid='ignore'):
+        determinant = a11*a22 - a12**2
+        thermal = (a22*b1 - a12*b2)/determinant
+        flicker = (a11*b2 - a12*b1)/determinant
 
-    # create theoretical thermal noise
-    thermal = [float(noise[-1])]*length
-    derivative = [1.0]
-    for n in range(1,length):
-        derivative.append(noise[n-1]-noise[n])
+    residual = psd.shape[-1] - 2*(thermal*b1 + flicker*b2) + thermal**2*a11 + 2*thermal*flicker*a12 + flicker**2*a22
 
-        if derivative[-1] > derivative[-2]:
-            thermal = [float(noise[n])]*length
-            break
+    # only a rising flicker over a positive floor is physical
+    residual = np.where((thermal > 0) & (flicker > 0) & np.isfinite(residual), residual, np.inf)
 
-    # find current corner frequency
-    corner_index = None
-    for i in range(length):
-        if flicker[i]-thermal[i] < 0:
-            corner_index = i
-            break
+    return thermal, flicker, residual
 
-    if corner_index:
 
-        # adjust flicker factor
-        while flicker[int(corner_index*0.5)]-noise[int(corner_index*0.5)] < 0:
 
-            # decrement the flicker factor and retest
-            flicker_factor -= 0.001
-            flicker = [float(noise[0])]
-            for i in range(1, length):
-                flicker.append( noise[0]/(np.sqrt(frequency[i]**flicker_factor) ) )
+def measure_noise_array(frequency, noise, slopes=np.arange(0.5, 2.501, 0.01)):
+    '''
+        Measure the corner frequency, flicker slope and thermal noise of many spectra at once
+
+        The noise is a (points x frequency) array of output noise spectra in
+        V/sqrt(Hz) and the frequency is either shared by every spectrum or the
+        same shape as the noise. The power spectrum is fitted as a thermal floor
+        plus a flicker term falling as 1/f**slope, searching the slopes given and
+        refining the best one by parabolic interpolation.
+
+        Returns arrays of the thermal noise (V/sqrt(Hz)), corner frequency and
+        slope of each spectrum, the corner and slope are nan where no flicker
+        noise is found.
+    '''
+
+    noise = np.atleast_2d(np.asarray(noise, dtype=float))
+    frequency = np.broadcast_to(np.asarray(frequency, dtype=float), noise.shape)
+    psd = noise**2
+
+    # residual of every candidate slope
+    residuals = np.array([_fit_flicker_thermal(frequency, psd, slope)[2] for slope in slopes])
+    best = np.argmin(residuals, axis=0)
+    points = np.arange(noise.shape[0])
 
-        # find the final corner frequency
-        for i in range(length):
-            if flicker[i]-thermal[i] < 0:
-                corner_index = i
-                corner_frequency = frequency[corner_index]
-                break
+    # refine between the neighbouring slopes
+    slope = slopes[best].astype(float)
+    inside = (best > 0) & (best < len(slopes)-1)
+    lower = residuals[np.maximum(best-1, 0), points]
+    middle = residuals[best, points]
+    upper = residuals[np.minimum(best+1, len(slopes)-1), points]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvature = lower - 2*middle + upper
+        offset = 0.5*(lower - upper)/curvature
+    refine = inside & np.isfinite(offset) & (curvature > 0)
+    slope[refine] += np.clip(offset[refine], -0.5, 0.5)*(slopes[1]-slopes[0])
 
-    else:
-        corner_frequency = None
-        flicker_factor = None
+    thermal, flicker, residual = _fit_flicker_thermal(frequency, psd, slope[:, None])
+
+    # a corner below the analysed band is only fitting the noise of the floor
+    found = np.isfinite(middle) & np.isfinite(residual) & (flicker > thermal)
+
+    # spectra without flicker noise are fitted with the floor alone
+    floor = np.sum(1/psd, axis=-1)/np.sum(1/psd**2, axis=-1)
+    thermal = np.where(found, thermal, floor)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corner_frequency = np.where(found, frequency[:, 0]*(flicker/thermal)**(1/slope), np.nan)
+    slope = np.where(found, slope, np.nan)
+
+    return np.sqrt(thermal), corner_frequency, slope
+
+
+
+def measure_noise(frequency=None, noise=None):
+    '''
+        Measure the corner frequency, slope factor of flicker noise and the thermal noise from simulation data 
+
+        A single spectrum version of measure_noise_array, the corner frequency and
+        slope are None when no flicker noise is found.
+    '''
 
+    thermal, corner_frequency, flicker_factor = measure_noise_array(frequency, noise)
 
-    return thermal[0], corner_frequency, flicker_factor
+    if np.isnan(corner_frequency[0]):
+        return thermal[0], None, None
 
+    return thermal[0], corner_frequency[0], flicker_factor[0]
@@ -0,0 +1,172 @@
+import os
+import hashlib
+import numpy as np
+
+from yaaade.spice.results import SimulationData
+
+
+class SimulationCache():
+    '''
+        Content addressed on-disk cache of simulation results
+
+        Results are keyed by a hash of the final netlist text, the contents of the
+        included model files and the simulator version. Each entry is stored as a
+        single .npz file and the least recently used entries are evicted once the
+        total size of the cache goes above the limit.
+
+        Only the files included directly by the netlist are hashed, changes to
+        files they include in turn are not detected. The included files must
+        exist, a netlist including a file which can't be found isn't cached.
+    '''
+
+    def __init__(self, path='rundir/cache', max_size=1e9):
+        '''
+            Setup the cache directory
+        '''
+
+        self.path = path
+        self.max_size = max_size
+
+        # hit/miss statistics
+        self.hits = 0
+        self.misses = 0
+
+        # digests of the model files, reused while the file is unchanged
+        self.file_digests = {}
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path, exist_ok=True)
+
+
+    def file_digest(self, path):
+        '''
+            Return the digest of a file, only rehashing it when it changes
+        '''
+
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        if path not in self.file_digests or self.file_digests[path][0] != signature:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+            self.file_digests[path] = (signature, digest.hexdigest())
+
+        return self.file_digests[path][1]
+
+
+    def key(self, netlist, include_files, simulator_version, extra=None):
+        '''
+            Create the key for a simulation
+        '''
+
+        digest = hashlib.sha256()
+        digest.update(str(netlist).encode('utf8'))
+        for path in include_files:
+            digest.update(self.file_digest(path).encode('utf8'))
+        digest.update(str(simulator_version).encode('utf8'))
+        digest.update(repr(extra).encode('utf8'))
+
+        return digest.hexdigest()
+
+
+    def entry_path(self, key):
+        '''
+            Return the path of the file for a cache entry
+        '''
+
+        return os.path.join(self.path, key + '.npz')
+
+
+    def load(self, key):
+        '''
+            Return the cached simulation data or None if there is no entry
+        '''
+
+        path = self.entry_path(key)
+
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        # mark the entry as recently used
+        os.utime(path)
+
+        # rebuild either a single dataset or a dictionary of datasets
+        with np.load(path, allow_pickle=False) as entry:
+            datasets = [_[:-len('.names')] for _ in entry.files if _.endswith('.names')]
+            simulation_data = {}
+            for dataset in datasets:
+                simulation_data[dataset] = SimulationData(entry[dataset + '.values'], [str(_) for _ in entry[dataset + '.names']])
+
+        if datasets == ['']:
+            return simulation_data['']
+        else:
+            return simulation_data
+
+
+    def store(self, key, simulation_data):
+        '''
+            Store the simulation data and evict old entries if needed
+        '''
+
+        # flatten the datasets into named arrays
+        arrays = {}
+        if isinstance(simulation_data, SimulationData):
+            simulation_data = {'' : simulation_data}
+        for dataset, data in simulation_data.items():
+            arrays[dataset + '.values'] = np.asarray(data.values)
+            arrays[dataset + '.names'] = np.array(data.names, dtype=str)
+
+        # write to a temporary file first so a partial entry is never read
+        path = self.entry_path(key)
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+
+        self.evict()
+
+
+    def evict(self):
+        '''
+            Remove the least recently used entries until the cache fits its size limit
+        '''
+
+        # entries can disappear underneath us when workers share the cache
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum([_[1] for _ in entries])
+        for mtime, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+    def statistics(self):
+        '''
+            Return the hit/miss statistics of the cache
+        '''
+
+        entries = [_ for _ in os.listdir(self.path) if _.endswith('.npz')]
+        lookups = self.hits + self.misses
+
+        return {'hits'      :   self.hits,
+                'misses'    :   self.misses,
+                'hit_rate'  :   self.hits/lookups if lookups else 0.0,
+                'entries'   :   len(entries),
+                'size'      :   sum([os.path.getsize(os.path.join(self.path, _)) for _ in entries])}
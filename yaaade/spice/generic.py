@@ -6,7 +6,12 @@ import re
 import h5py
 import subprocess
 import fnmatch
-from spyci import spyci
+
+from yaaade.spice.cache import SimulationCache
+from yaaade.spice.netlist import Netlist
+from yaaade.spice.rawfile import read_raw
+from yaaade.spice.results import SimulationData
+from yaaade.spice.timing import StageTimer
 
 
 import matplotlib.pyplot as plt
@@ -40,6 +45,18 @@ class GenericSpiceInterface():
         self.simulation = {}
         self.config = {}
 
+        # directory holding the temporary netlist and simulation outputs
+        self.config['rundir'] = 'rundir'
+
+        # directories the relative includes of the netlist are found from
+        self.config['netlist_dir'] = None
+        self.config['pdk_path'] = pdk_path
+
+        # results cache, disabled until enable_cache() is called
+        self.config['cache'] = None
+
+        # per stage timing, disabled until enable_timing() is called
+        self.config['timer'] = None
 
         # if provided read in the base netlist
         if netlist_path:
@@ -57,11 +74,55 @@ class GenericSpiceInterface():
             Read in a netlist from file
         '''
 
+        # parse the netlist once so later edits only touch the affected lines
         with open(netlist_path) as f:
-            self.simulation['netlist'] = f.read()
+            self.simulation['netlist'] = Netlist(f.read())
+
+        # relative includes are found from the directory of the netlist
+        self.config['netlist_dir'] = os.path.dirname(os.path.abspath(netlist_path))
+
+
+    def resolved_include_files(self):
+        '''
+            Return the absolute paths of the files included by the netlist
+
+            Relative paths are looked up in the directory of the netlist, the PDK
+            path and then the working directory. None is returned if any included
+            file can't be found, as the results then can't be tied to the models.
+        '''
+
+        search_dirs = [_ for _ in [self.config['netlist_dir'], self.config['pdk_path'], os.getcwd()] if _]
+
+        paths = []
+        for include_file in self.simulation['netlist'].include_files():
+            include_file = os.path.expanduser(include_file)
+            if os.path.isabs(include_file):
+                candidates = [include_file]
+            else:
+                candidates = [os.path.join(_, include_file) for _ in search_dirs]
+
+            found = [_ for _ in candidates if os.path.isfile(_)]
+            if not found:
+                return None
+            paths.append(os.path.abspath(found[0]))
+
+        return paths
+
+
+
+    def temp_file(self, suffix, rundir=None):
+        '''
+            Return the path of a temporary simulation file inside the run directory
+        '''
+
+        if rundir is None:
+            rundir = self.config['rundir']
 
-            # the line continuation is not needed as messes up parsing, remove it
-            self.simulation['netlist'] = re.sub(r'\n\+', '', self.simulation['netlist'])
+        # make sure the run directory exists
+        if not os.path.exists(rundir):
+            os.makedirs(rundir, exist_ok=True)
+
+        return os.path.join(rundir, 'spiceinterface_temp' + suffix)
 
 
 
@@ -70,11 +131,8 @@ class GenericSpiceInterface():
             Add a simulation command to the netlist
         '''
 
-        # wrap the command in new lines
-        command = "\n" + command + "\n"
-
-        # remove the .end keyword and append
-        self.simulation['netlist'] = re.sub(r'\.end[$\n]', command + "\n.end\n", self.simulation['netlist'])
+        # wrap the command in new lines and add in front of the .end keyword
+        self.simulation['netlist'].append("\n" + command + "\n")
 
 
 
@@ -84,10 +142,7 @@ class GenericSpiceInterface():
         '''
 
         # change the temperature in the netlist
-        sub_string = ".param temp=%f" % temp
-        self.simulation['netlist'] = re.sub(r'\.param temp=.*', sub_string, self.simulation['netlist'])
-        sub_string = ".temp %f" % temp
-        self.simulation['netlist'] = re.sub(r'\.temp .*', sub_string, self.simulation['netlist'])
+        self.simulation['netlist'].set_temperature(temp)
 
         # update user
         if self.config['verbose']:
@@ -99,17 +154,21 @@ class GenericSpiceInterface():
     def set_corner(self, corner):
         '''
             Set the simulation corner
+
+            Returns the number of library lines changed, 0 when the netlist does
+            not load the corners from a library.
         '''
 
-        # change the temperature in the netlist
-        sub_string = r"\1sky130.lib.spice %s" % corner
-        self.simulation['netlist'] = re.sub(r'(\.lib .*)sky130.lib.spice .*', sub_string, self.simulation['netlist'])
+        # change the library section in the netlist
+        changed = self.simulation['netlist'].set_lib_section('sky130.lib.spice', corner)
 
         # update user
         if self.config['verbose']:
             log_information = "New corner: %s" % corner
             print(log_information)
 
+        return changed
+
 
 
     def find_device_type(self, device):
@@ -117,36 +176,8 @@ class GenericSpiceInterface():
             Traverse the netlist heirarchy to find the device type for a given reference designator
         '''
 
-         # delete all subcircuits
-            # \n\.subckt[\s\S]*?\.ends
-        temp_netlist = re.sub(r'\n\.subckt[\s\S]*?\.ends', '', self.simulation['netlist'])
-
-        # split the heirarchy
-        heirarchy = device.split('.')
-
-        # device is in subcircuit
-        if len(heirarchy) > 1:
-
-            # descend the heirarchy
-            for component in heirarchy[:-1]:
-
-                # find the subcircuit name for the instance
-                search_str = component + ' .*(?<!=) (\w+)(?!=)'
-                regex = re.search(search_str, temp_netlist)
-                subcircuit_name = regex.group(1)
-
-                # delete everything apart from the current subcircuit+
-                search_str = r'\n\.subckt '+subcircuit_name+r' [\s\S]+?\.ends'
-                regex = re.search(search_str, self.simulation['netlist'])
-                temp_netlist = regex.group(0)
-
-
-        # find the device type
-        search_str = heirarchy[-1] + r'.*(sky130\S*)'
-        regex = re.search(search_str, temp_netlist)
-        device_type = regex.group(1)
-
-        return device_type
+        # the hierarchy index is cached until the netlist changes
+        return self.simulation['netlist'].hierarchy().find_model(device)
 
 
     def find_mosfets_in_subcircuit(self, devices, search_subcircuit=None, refdes_list=None):
@@ -154,65 +185,15 @@ class GenericSpiceInterface():
             Traverse the netlist heirarchy to find all MOSFETs
         '''
 
-        try:
-
-            # look in a subcircuit
-            if search_subcircuit:
-
-                # delete everything apart from the current subcircuit+
-                search_str = r'\n\.subckt ' + search_subcircuit + r' [\s\S]+?\.ends'
-                regex = re.search(search_str, self.simulation['netlist'])
-                temp_netlist = regex.group(0)
-
-            # look at the top level
-            else:
-
-                # delete all subcircuits
-                temp_netlist = re.sub(r'\n\.subckt[\s\S]*?\.ends', '', self.simulation['netlist'])
-                refdes_list = []
-
+        # the prefix of the starting point in the heirarchy
+        subcircuit_prefix = ''
+        for level in refdes_list or []:
+            subcircuit_prefix += level + '.'
 
-            # find all subcircuits at this level
-            search_str = r'\n([x|X].*)'
-            subcircuits = re.findall(search_str, temp_netlist)
-
-            # find subcircuits and pull out sky130 devices on this level
-            for subcircuit in subcircuits[::-1]:
-                if 'sky130_fd_pr_' in subcircuit:
-
-                    subcircuit_prefix = ''
-                    for level in refdes_list:
-                        subcircuit_prefix += level + '.'
-
-                    subcircuit_name = subcircuit_prefix + subcircuit.split(' ')[0]
-
-                    devices.append(subcircuit_name)
-                    subcircuits.remove(subcircuit)
-
-            # find the name of further subcircuits
-            subcircuits_names = []
-            for subcircuit in subcircuits:
-
-                temp = subcircuit.split(' ')
-
-                for item in temp[::-1]:
-                    if not '=' in item:
-                        subcircuits_names.append([item, temp[0]])
-                        break
-
-            # recursively look into each circuit
-            for subcircuit_name in subcircuits_names:
-
-                if not 'sky130_fd_sc' in subcircuit_name[0]:
-
-                    # append the reference designator list and search the next level down
-                    current_refdes_list = refdes_list + [subcircuit_name[1]]
-                    self.find_mosfets_in_subcircuit(devices, search_subcircuit=subcircuit_name[0], refdes_list=current_refdes_list)
-
-        except:
-
-            print("find_mosfets_in_subcircuit() - Failed to find MOSFETs in this level of heirarchy, you may want to look into it")
-            print("  Provided with deviced: ", devices)
+        # take the devices below that point from the hierarchy index
+        for device in self.simulation['netlist'].hierarchy().devices:
+            if device.lower().startswith(subcircuit_prefix.lower()):
+                devices.append(device)
 
 
 
@@ -221,11 +202,7 @@ class GenericSpiceInterface():
             Traverse the netlist heirarchy to find all MOSFETs
         '''
 
-        devices = []
-
-        self.find_mosfets_in_subcircuit(devices)
-
-        return devices
+        return list(self.simulation['netlist'].hierarchy().devices)
 
 
 
@@ -239,10 +216,11 @@ class GenericSpiceInterface():
 
         # loop through devices and parameters
         for device in devices:
-            for expression in expressions:
 
-                # get the device type 
-                device_type = self.find_device_type(device)
+            # get the device type 
+            device_type = self.find_device_type(device)
+
+            for expression in expressions:
 
                 # vsat_marg is not in devices so need to form that ourselves
                 if expression == "vsat_marg":
@@ -251,9 +229,8 @@ class GenericSpiceInterface():
                 else:
                     command += '@M.' + device + '.m' + device_type + '[' + expression + '] '
 
-        # remove the .end keyword and append
-        # self.simulation['netlist'] = re.sub(r'\.end$', command + "\n.end", self.simulation['netlist'])
-        self.simulation['netlist'] = re.sub(r'\.end[$\n]', command + "\n.end", self.simulation['netlist'])
+        # add in front of the .end keyword
+        self.simulation['netlist'].append(command)
 
 
     def plot_op_save(self, devices, expressions, sweepvar, linewidth=1.0, alpha=1.0, 
@@ -458,19 +435,115 @@ class GenericSpiceInterface():
         self.ngspice.exec_command("remcirc")
 
         # write the temporary netlist
-        with open('spiceinterface_temp.spice', 'w') as f:
-            f.write(self.simulation['netlist'])
+        with open(self.temp_file('.spice'), 'w') as f:
+            f.write(str(self.simulation['netlist']))
 
         # reload the circuit
         if self.config['simulator']['silent']:
             with suppress_stdout_stderr():
-                self.ngspice.source('spiceinterface_temp.spice')
+                self.ngspice.source(self.temp_file('.spice'))
         else:
-            self.ngspice.source('spiceinterface_temp.spice')
+            self.ngspice.source(self.temp_file('.spice'))
+
+
+
+    def enable_cache(self, path=None, max_size=1e9):
+        '''
+            Cache the simulation results on disk
+
+            Identical simulations are then read back from the cache rather than rerun,
+            the statistics are available from self.config['cache'].statistics()
+        '''
+
+        if path is None:
+            path = os.path.join(self.config['rundir'], 'cache')
+
+        self.config['cache'] = SimulationCache(path, max_size)
+
+
+    def enable_timing(self):
+        '''
+            Record the time spent in each stage of the simulations
+
+            The stages are available from self.config['timer'].report()
+        '''
+
+        self.config['timer'] = StageTimer()
+
+        return self.config['timer']
+
+
+    def stage(self, name):
+        '''
+            Return a context timing the named stage when timing is enabled
+        '''
+
+        if self.config['timer'] is None:
+            return contextlib.nullcontext()
 
+        return self.config['timer'].stage(name)
 
 
-    def run_simulation(self, new_instance=True, outputs=None):
+    def simulator_version(self):
+        '''
+            Return the version of the simulator used to key cached results
+        '''
+
+        return self.config['simulator']['executable']
+
+
+    def run_simulation(self, new_instance=True, outputs=None, **kwargs):
+        '''
+            Run simulation
+
+            When the cache is enabled the results of an identical netlist are read
+            back rather than simulated again. The circuit is still loaded into the
+            simulator on a hit since runs which reuse the loaded circuit
+            (new_instance=False) follow on from it, those runs always simulate as
+            their results can differ. Netlists including a file which can't be
+            found are never cached.
+        '''
+
+        cache = self.config.get('cache') if new_instance else None
+        include_files = self.resolved_include_files() if cache else None
+
+        if cache and include_files is not None:
+
+            # key on everything that can change the results
+            key = cache.key(self.simulation['netlist'],
+                            include_files,
+                            self.simulator_version(),
+                            extra=[outputs, sorted(kwargs.items())])
+
+            simulation_data = cache.load(key)
+            if simulation_data is not None:
+                self.simulation_data = simulation_data
+
+                # later runs with new_instance=False simulate the circuit of this one
+                self._load_circuit()
+                return
+
+        self._run_simulation(new_instance=new_instance, outputs=outputs, **kwargs)
+
+        if cache and include_files is not None:
+            cache.store(key, self.simulation_data)
+
+
+    def _load_circuit(self):
+        '''
+            Load the netlist into a simulator which keeps it between runs, without simulating
+        '''
+
+        if self.config['simulator']['executable'] == 'ngspice' and self.config['simulator']['shared']:
+
+            with open(self.temp_file('.spice'), 'w') as f:
+                f.write(str(self.simulation['netlist']))
+
+            self.ngspice.destroy()
+            self.ngspice.source(self.temp_file('.spice'))
+
+
+    def _run_simulation(self, new_instance=True, outputs=None):
         '''
             Run simulation
         '''
@@ -479,8 +552,8 @@ class GenericSpiceInterface():
         if self.config['simulator']['executable'] == 'ngspice':
 
             # write the temporary netlist
-            with open('spiceinterface_temp.spice', 'w') as f:
-                f.write(self.simulation['netlist'])
+            with open(self.temp_file('.spice'), 'w') as f:
+                f.write(str(self.simulation['netlist']))
 
             # run ngspice
             if self.config['simulator']['shared']:
@@ -491,7 +564,7 @@ class GenericSpiceInterface():
 
                 # load the netlist into the 
                 if new_instance:
-                    self.ngspice.source('spiceinterface_temp.spice')
+                    self.ngspice.source(self.temp_file('.spice'))
 
                 # run the simulation
                 if self.config['simulator']['silent']:
@@ -501,22 +574,22 @@ class GenericSpiceInterface():
                     self.ngspice.run()
 
                 # save the outputs
-                self.ngspice.exec_command("set filetype=ascii")
-                self.ngspice.exec_command("write spiceinterface_temp.raw")
+                self.ngspice.exec_command("set filetype=binary")
+                self.ngspice.exec_command("write " + self.temp_file('.raw'))
 
 
             else:
 
-                # set the output format to ascii required by spyci
-                os.environ["SPICE_ASCIIRAWFILE"] = "1"
+                # use the compact binary output format
+                os.environ["SPICE_ASCIIRAWFILE"] = "0"
 
                 # run the simulation through command line
-                bash_command = "ngspice -b -r spiceinterface_temp.raw -o spiceinterface_temp.out spiceinterface_temp.spice"
+                bash_command = "ngspice -b -r %s -o %s %s" % (self.temp_file('.raw'), self.temp_file('.out'), self.temp_file('.spice'))
                 process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
                 output, error = process.communicate()
 
                 # check if error occured
-                with open('spiceinterface_temp.out') as f:
+                with open(self.temp_file('.out')) as f:
                     sim_log = f.read()
                     if 'fatal' in sim_log or 'aborted' in sim_log:
                         print('\033[91m')
@@ -530,21 +603,25 @@ class GenericSpiceInterface():
             if outputs:
                 self.simulation_data = {}
                 for output in outputs:
-                    self.read_results("rundir/spiceinterface_temp_"+output+".raw", output)
+                    self.read_results(self.temp_file('_' + output + '.raw'), output)
             else:
-                self.read_results("rundir/spiceinterface_temp.raw")
+                self.read_results(self.temp_file('.raw'))
 
         else:
             assert False, 'The simulator (%s) is not currently supported' % self.config['simulator']
 
 
-    def monte_carlo(self, number_runs, analysis, signals, measurements=None):
+    def monte_carlo(self, number_runs, analysis, signals, measurements=None, workers=None):
         """
             Perform Monte-Carlo simulation
 
             Both signals and measurements should be list of dictionaries with:
                 name
                 plot
+
+            Run i is simulated with the seed i+1, either in this process or
+            with workers concurrently across a pool of worker processes, so both
+            give the same results. These are then plotted in run order.
         """
 
         # use the shared simulator interface
@@ -567,14 +644,31 @@ class GenericSpiceInterface():
         # 
         # if number_plots > 0:
 
+        # run every seed up front in isolated worker processes
+        if workers:
+
+            from yaaade.spice.parallel import run_parallel
+
+            print('Running %d Monte-Carlo runs across %d workers' % (number_runs, workers))
+            jobs = [{'seed' : i+1} for i in range(number_runs)]
+            run_results = run_parallel(self, jobs, workers=workers)
+
         # loop through the simulation
+        netlist = self.simulation['netlist']
         data = []
         for i in range(number_runs):
 
-            print('Beginning run %d of %d' % (i+1, number_runs))
+            # take the results from the worker or run the simulation with the same seed
+            if workers:
+                self.simulation_data = run_results[i]
+            else:
+                print('Beginning run %d of %d' % (i+1, number_runs))
+                self.simulation['netlist'] = netlist.copy()
+                self.set_seed(i+1)
+                self.run_simulation(new_instance=True)
+                self.simulation['netlist'] = netlist
 
-            # run the simulation
-            self.run_simulation(new_instance=(i==0))
+            data.append(self.simulation_data)
 
             # # get the signals
             # temp_dict = {}
@@ -604,49 +698,65 @@ class GenericSpiceInterface():
                     self.plot_bode('v(ac)', linewidth=1, alpha=0.5, interactive=True, append=True)
                 else:
                     self.plot_bode('v(ac)', linewidth=1, alpha=0.5, interactive=True)
+
+        return data
             
 
 
+    def set_seed(self, seed):
+        '''
+            Set the random seed used for Monte-Carlo variation
+        '''
+
+        # add the seed option to the netlist
+        self.set_sim_command('.option seed=%d' % seed)
+
+
+
     def monte_carlo_parameters_append(self):
         '''
             Append Monte-Carlo parameters
         '''
 
-        # remove the end command at the end of the netlist
-        self.simulation['netlist'] = re.sub(r'\.end[$\n]', '', self.simulation['netlist'])
-
-        # add the parameters
-        self.simulation['netlist'] += '\n\n* MONTE CARLO PARAMETERS'
+        # add the parameters in front of the end command
+        command = '\n\n* MONTE CARLO PARAMETERS'
         for parameter in self.monte_carlo_parameters:
             assert parameter[1] == "gauss"
-            self.simulation['netlist'] += "\n.param %s_spectre='agauss(0, %f, %d)/%s'" % (parameter[0], parameter[2], self.monte_carlo_sigma, parameter[0])    
-        self.simulation['netlist'] += '\n\n\n'
+            command += "\n.param %s_spectre='agauss(0, %f, %d)/%s'" % (parameter[0], parameter[2], self.monte_carlo_sigma, parameter[0])    
+        command += '\n\n\n'
 
-        # append the end command we previously removed
-        self.simulation['netlist'] += '\n.end\n'
+        self.simulation['netlist'].append(command)
 
 
 
-    def read_results(self, netlist="spiceinterface_temp.raw", dataset=None):
+    def load_results(self, netlist="spiceinterface_temp.raw", plot=0, mmap=False):
         '''
-            Read the simulation resutls from file
+            Load a plot of a raw file without storing it as the current results
+
+            The data is copied out of the file unless mmap is set, which must only
+            be used for files that are not rewritten by later runs.
+        '''
+
+        raw_data = read_raw(netlist, mmap)[plot]
+
+        # keep the data as a single array indexed by the signal name
+        return SimulationData(raw_data['values'], [data_var['name'] for data_var in raw_data['vars']])
+
+
+    def read_results(self, netlist="spiceinterface_temp.raw", dataset=None, plot=0, mmap=False):
         '''
+            Read the simulation resutls from file
 
-        raw_data = spyci.load_raw(netlist)
-        simulation_data = {}
+            Both binary and ASCII raw files are supported, when the file holds several
+            plots the one to read is selected with its index. See load_results for mmap.
+        '''
 
-        # pull out the data from the raw format into a nicer dictionary
-        # with the signal name as the key
-        for data_i, data_var in enumerate(raw_data['vars']):
-            simulation_data[data_var['name']] = []
-            for n in range(len(raw_data['values'])):
-                simulation_data[data_var['name']].append(raw_data['values'][n][data_i])
+        simulation_data = self.load_results(netlist, plot, mmap)
 
         # single simulation data or multiple
         if dataset == None:
             self.simulation_data = simulation_data
         else:
-            self.simulation_data = {}
             self.simulation_data[dataset] = simulation_data
 
 
@@ -659,18 +769,18 @@ class GenericSpiceInterface():
         step_size = (end - start)/(number_steps-1)
 
 
-        if self.config['simulator']['shared']:
-            print("NOT IMPLEMENTED EFFICIENTLY!!!! - set_dc_sweep()")
-    
         # update the netlist
         sub_string = ".dc %s %0.12f %0.12f %0.12f" % (parameter, start, end, step_size)
-        self.simulation['netlist'] = re.sub(r'\.dc .*', sub_string, self.simulation['netlist'])
+        self.simulation['netlist'].set_analysis('.dc', sub_string)
 
 
 
     def get_signal(self, signal_name, factor=1.0, dataset=None, complex_out=False):
         '''
             Return a signal from the simulation results
+
+            The signal is a view of the stored results unless a factor is applied or
+            the imaginary part needs to be stripped.
         '''
 
         # grab the simulation dataset requested
@@ -679,31 +789,46 @@ class GenericSpiceInterface():
         else:
             simulation_data = self.simulation_data
 
-        # extract each data point and convert to real list
-        if factor != 1.0 or (complex_out==False and np.iscomplex(simulation_data[signal_name.lower()][0])):
-            data = []
-            for n in range(len(simulation_data[signal_name.lower()])):
+        data = simulation_data[signal_name.lower()]
 
-                if complex_out:
-                    data.append(factor*simulation_data[signal_name.lower()][n])
-                else:
-                    data.append(factor*np.real(simulation_data[signal_name.lower()][n]))
+        # convert to real values unless complex values are requested
+        if not complex_out and np.iscomplexobj(data):
+            data = data.real
 
-            return data
-        
-        else:
-            return simulation_data[signal_name.lower()]
+        # scale the whole signal at once
+        if factor != 1.0:
+            data = factor*data
+
+        return data
 
 
-    def get_signals(self, signal_names, factor=1.0):
+    def get_signals(self, signal_names, factor=1.0, dataset=None, as_array=False):
         '''
             Return one or more signals from the simulation results
+
+            With as_array the signals are returned as one (points x signals) array
+            rather than a dictionary.
         '''
 
+        # pull all the columns out in a single indexing operation
+        if as_array:
+
+            # grab the simulation dataset requested
+            if dataset:
+                simulation_data = self.simulation_data[dataset]
+            else:
+                simulation_data = self.simulation_data
+
+            data = simulation_data.columns([signal.lower() for signal in signal_names])
+            if np.iscomplexobj(data):
+                data = data.real
+
+            return factor*data if factor != 1.0 else data
+
         # loop through each signal
         data_dict = {}
         for signal in signal_names:
-            data_dict[signal] = self.get_signal(signal, factor)
+            data_dict[signal] = self.get_signal(signal, factor, dataset=dataset)
 
         return data_dict
 
@@ -719,28 +844,41 @@ class GenericSpiceInterface():
         else:
             simulation_data = self.simulation_data
 
-        # extract each data point and convert to real list
+        # the swept parameter is always the first variable
         index = 0
-        data = []
-        for n in range(len(simulation_data['values'])):
-            data.append(np.real(simulation_data['values'][n][index]))
+        data = simulation_data.values[:, index].real
 
         # return just the data or include the name of the swept parameter?
         if return_name:
-            return data, simulation_data['vars'][index]
+            return data, simulation_data.names[index]
         else:
             return data
 
 
 
-    def sweep_parameter(self, parameter, start, end, number_steps, signals, sweeptype='singlestep'):
+    def run_batched_sweep(self, parameter, values, outputs=None):
+        '''
+            Run a parameter or temperature sweep in a single simulator session
+        '''
+
+        assert False, 'Batched sweeps are not supported for the simulator (%s)' % self.config['simulator']['executable']
+
+
+
+    def sweep_parameter(self, parameter, start, end, number_steps, signals, sweeptype='singlestep', workers=None, dataset=None):
         '''
             Sweep the temperature and provide the resulting signals
+
+            With sweeptype='singlestep' the sweep points can be spread over a pool
+            of worker processes by setting workers to the number of processes.
+            With sweeptype='batched' the whole sweep runs in a single simulator
+            session where the simulator supports it, the signals of a netlist
+            with more than one analysis are read from the output given by dataset.
         '''
 
         # start/stop the simulator for each sweep step
         # this is slower but more flexible
-        if sweeptype == 'singlestep':
+        if sweeptype in ['singlestep', 'batched']:
 
             # create temperature list
             parameter_list = np.linspace(start, end, number_steps)
@@ -753,28 +891,59 @@ class GenericSpiceInterface():
             for signal in signals:
                 results[signal] = []
 
+            # run the whole sweep in one simulator session
+            if sweeptype == 'batched':
+
+                point_results = []
+                for point_data in self.run_batched_sweep(parameter, parameter_list, outputs=[dataset] if dataset else None):
+                    assert dataset or not isinstance(point_data, dict), 'The netlist has more than one analysis, set the dataset to one of %s' % list(point_data)
+                    self.simulation_data = point_data
+                    point_results.append({signal : self.get_signal(signal, dataset=dataset) for signal in signals})
+
+            # run the sweep points concurrently in isolated worker processes
+            elif workers:
+
+                from yaaade.spice.parallel import run_parallel
+
+                # create a job for each sweep point
+                jobs = []
+                for parameter_value in parameter_list:
+                    if parameter == 'temp':
+                        jobs.append({'temperature' : parameter_value})
+                    else:
+                        jobs.append({'parameters' : [[parameter, float(parameter_value)]]})
+
+                point_results = run_parallel(self, jobs, signals=signals, workers=workers)
+
             # loop through the temperatures
-            for parameter_value in parameter_list:
+            else:
 
-                # update the netlist
-                if parameter == 'temp':
-                    self.set_temperature(parameter_value)
-                else:
-                    self.set_parameters([[parameter, float(parameter_value)]])
+                point_results = []
+                for parameter_value in parameter_list:
 
-                # run the simulation
-                self.run_simulation()
+                    # update the netlist
+                    if parameter == 'temp':
+                        self.set_temperature(parameter_value)
+                    else:
+                        self.set_parameters([[parameter, float(parameter_value)]])
+
+                    # run the simulation
+                    self.run_simulation()
+
+                    # grab the results
+                    point_results.append({signal : self.get_signal(signal) for signal in signals})
 
-                # grab the results
+            # merge the results in sweep order
+            for point_result in point_results:
                 for signal in signals:
 
-                    temp_signal = self.get_signal(signal)
+                    temp_signal = point_result[signal]
 
                     # if a single point is returned we don't want unnecessary list depth
                     if len(temp_signal) == 1:
-                        results[signal] = temp_signal[0]
+                        results[signal].append(temp_signal[0])
                     else:
-                        results[signal] = temp_signal
+                        results[signal].append(temp_signal)
 
         # edit the DC sweep commad
         elif sweeptype == 'dcsweep':
@@ -0,0 +1,413 @@
+import re
+
+
+# directives that define an analysis
+ANALYSES = ['.op', '.dc', '.ac', '.tran', '.noise', '.tf', '.sens', '.pz', '.disto']
+
+# directives that pull in other files
+INCLUDES = ['.include', '.inc', '.lib', 'include']
+
+
+class Netlist():
+    '''
+        Structured model of a SPICE netlist
+
+        The netlist is parsed once into a list of lines together with an index of
+        the parameters, temperature statements, includes, analyses, control blocks,
+        subcircuits and instances. Edits only touch the indexed lines so they don't
+        need to scan the whole text, and the text is rebuilt lazily when needed.
+
+        Spectre 'parameters' statements are indexed alongside SPICE '.param' lines.
+    '''
+
+    def __init__(self, text=''):
+        '''
+            Parse the netlist text
+        '''
+
+        self.version = 0
+        self.parse(text)
+
+
+    def parse(self, text):
+        '''
+            Build the structured model from the netlist text
+        '''
+
+        # the line continuation is not needed as messes up parsing, remove it
+        text = re.sub(r'\n\+', '', text)
+
+        # split off the end statement and anything after it
+        lines = text.split('\n')
+        end_index = None
+        for i in range(len(lines)-1, -1, -1):
+            if lines[i].strip().lower() == '.end':
+                end_index = i
+                break
+
+        if end_index is None:
+            self.lines = []
+            self.end = None
+            self.tail = []
+        else:
+            self.lines = []
+            self.end = lines[end_index]
+            self.tail = lines[end_index+1:]
+            lines = lines[:end_index]
+
+        # create the empty indexes
+        self.params = {}
+        self.temps = []
+        self.includes = []
+        self.analyses = {}
+        self.controls = []
+        self.subcircuits = {}
+        self.instances = {None : {}}
+
+        # state of the parser
+        self._scope = None
+        self._control_start = None
+
+        # index each line
+        for line in lines:
+            self.lines.append(line)
+            self._index_line(len(self.lines)-1)
+
+        self._modified()
+
+
+    def _modified(self):
+        '''
+            Invalidate the cached text after a change
+        '''
+
+        self.version += 1
+        self._text = None
+
+
+    def _index_line(self, i):
+        '''
+            Add a single line to the indexes
+        '''
+
+        line = self.lines[i].strip()
+        if not line:
+            return
+
+        tokens = line.split()
+        keyword = tokens[0].lower()
+
+        # everything inside a control block belongs to the block
+        if self._control_start is not None:
+            if keyword == '.endc':
+                self.controls.append((self._control_start, i))
+                self._control_start = None
+            return
+
+        # skip comments
+        if line.startswith('*') or line.startswith('//'):
+            return
+
+        if keyword == '.control':
+            self._control_start = i
+
+        elif keyword == '.subckt':
+            self._scope = tokens[1].lower()
+            self.subcircuits[self._scope] = {'start' : i, 'end' : None, 'ports' : [_ for _ in tokens[2:] if '=' not in _]}
+            self.instances[self._scope] = {}
+
+        elif keyword == '.ends':
+            if self._scope is not None:
+                self.subcircuits[self._scope]['end'] = i
+            self._scope = None
+
+        elif keyword in ['.param', 'parameters']:
+            for match in re.finditer(r'(\w+)\s*=', line):
+                self.params[match.group(1).lower()] = i
+
+        elif keyword == '.temp':
+            self.temps.append(i)
+
+        elif keyword in INCLUDES:
+            self.includes.append(i)
+
+        elif keyword in ANALYSES:
+            self.analyses.setdefault(keyword, []).append(i)
+
+        elif not keyword.startswith('.'):
+            self.instances[self._scope][keyword] = i
+
+
+    def __str__(self):
+        '''
+            Serialise the netlist back to text
+        '''
+
+        if self._text is None:
+            lines = [_ for _ in self.lines if _ is not None]
+            if self.end is not None:
+                lines += [self.end] + self.tail
+            self._text = '\n'.join(lines)
+
+        return self._text
+
+
+    def copy(self):
+        '''
+            Return an independent copy of the netlist
+        '''
+
+        return Netlist(str(self))
+
+
+    def substitute(self, pattern, replacement):
+        '''
+            Apply a regular expression substitution to the whole text and reparse
+
+            This is intended for one-off template edits rather than inner loops.
+        '''
+
+        self.parse(re.sub(pattern, replacement, str(self)))
+
+
+    def append(self, text):
+        '''
+            Add lines to the netlist in front of the .end statement
+        '''
+
+        for line in text.split('\n'):
+            self.lines.append(line)
+            self._index_line(len(self.lines)-1)
+
+        self._modified()
+
+
+    def remove_lines(self, indices):
+        '''
+            Remove lines, keeping the indexes of the other lines valid
+        '''
+
+        for i in indices:
+            self.lines[i] = None
+
+        self._modified()
+
+
+    def set_param(self, name, value):
+        '''
+            Change the value of a parameter in place
+
+            Returns False when the parameter isn't defined in the netlist.
+        '''
+
+        i = self.params.get(name.lower())
+        if i is None:
+            return False
+
+        # only the line holding the parameter is touched
+        self.lines[i] = re.sub(r'(\b%s\s*=\s*)(\'[^\']*\'|\{[^}]*\}|\S+)' % re.escape(name),
+                                lambda match: match.group(1) + str(value), self.lines[i], count=1, flags=re.IGNORECASE)
+        self._modified()
+
+        return True
+
+
+    def get_param(self, name):
+        '''
+            Return the value of a parameter as a string
+        '''
+
+        i = self.params.get(name.lower())
+        if i is None:
+            return None
+
+        match = re.search(r'\b%s\s*=\s*(\'[^\']*\'|\{[^}]*\}|\S+)' % re.escape(name), self.lines[i], flags=re.IGNORECASE)
+
+        return match.group(1)
+
+
+    def set_temperature(self, temp):
+        '''
+            Set the temperature parameter and statements
+        '''
+
+        self.set_param('temp', '%f' % temp)
+        for i in self.temps:
+            self.lines[i] = '.temp %f' % temp
+
+        self._modified()
+
+
+    def set_lib_section(self, library, section):
+        '''
+            Change the section loaded from a library (ie. the process corner)
+
+            Both the spice form (.lib "<path>" tt) and the spectre form (include
+            "<path>" section=tt) are changed. Returns the number of lines changed,
+            0 when the netlist has no line loading a section of the library.
+        '''
+
+        changed = 0
+        for i in self.includes:
+            if self.lines[i] is not None and self.lines[i].split()[0].lower() in ['.lib', 'include'] and library in self.lines[i]:
+                line, count = re.subn(r'(%s\S*\s+(?:section\s*=\s*)?)\S+\s*$' % re.escape(library), r'\g<1>%s' % section, self.lines[i])
+                self.lines[i] = line
+                changed += count
+
+        self._modified()
+
+        return changed
+
+
+    def include_files(self):
+        '''
+            Return the paths of all the included files
+        '''
+
+        paths = []
+        for i in self.includes:
+            if self.lines[i] is not None:
+                match = re.match(r'\s*\S+\s+[\'"]?([^\'"\s]+)', self.lines[i])
+                if match:
+                    paths.append(match.group(1))
+
+        return paths
+
+
+    def set_analysis(self, analysis, command):
+        '''
+            Replace an analysis statement, adding it if not already present
+        '''
+
+        indices = self.analyses.get(analysis, [])
+
+        if indices:
+            self.lines[indices[0]] = command
+            self.remove_lines(indices[1:])
+            self.analyses[analysis] = indices[:1]
+            self._modified()
+        else:
+            self.append(command)
+
+
+    def remove_analyses(self, analyses=None):
+        '''
+            Remove the analysis statements, by default of every type
+        '''
+
+        for analysis in list(self.analyses):
+            if analyses is None or analysis in analyses:
+                self.remove_lines(self.analyses.pop(analysis))
+
+
+    def remove_controls(self):
+        '''
+            Remove all the control blocks
+        '''
+
+        for start, end in self.controls:
+            self.remove_lines(range(start, end+1))
+        self.controls = []
+
+
+    def hierarchy(self):
+        '''
+            Return the hierarchy index of the netlist
+
+            The index is built on first use and rebuilt automatically once the
+            netlist has been changed.
+        '''
+
+        if getattr(self, '_hierarchy', None) is None or self._hierarchy.version != self.version:
+            self._hierarchy = HierarchyIndex(self)
+
+        return self._hierarchy
+
+
+
+class HierarchyIndex():
+    '''
+        Flattened view of the subcircuit hierarchy of a netlist
+
+        Maps every instance path (ie. 'X1.XM2') to the subcircuit or model it
+        instantiates and keeps the list of PDK devices grouped by model. Each
+        subcircuit is only expanded once however many times it is instantiated.
+    '''
+
+    def __init__(self, netlist, device_prefix='sky130_fd_pr_', exclude_prefix='sky130_fd_sc'):
+        '''
+            Build the index from the parsed netlist
+        '''
+
+        self.version = netlist.version
+        self.device_prefix = device_prefix
+        self.exclude_prefix = exclude_prefix
+
+        self.models = {}
+        self.devices = []
+        self.devices_by_model = {}
+
+        # expand the hierarchy from the top level
+        self._netlist = netlist
+        self._expanded = {}
+        for path, model, is_device in self._expand(None):
+            self.models[path.lower()] = model
+            if is_device:
+                self.devices.append(path)
+                self.devices_by_model.setdefault(model, []).append(path)
+
+        del self._netlist, self._expanded
+
+
+    def _expand(self, scope):
+        '''
+            Return the (path, model, is_device) entries below a subcircuit
+        '''
+
+        if scope in self._expanded:
+            return self._expanded[scope]
+
+        # guard against recursive definitions
+        self._expanded[scope] = []
+
+        devices = []
+        subcircuits = []
+        for name, i in self._netlist.instances.get(scope, {}).items():
+
+            line = self._netlist.lines[i]
+            if line is None or not name.startswith('x'):
+                continue
+
+            # the subcircuit name is the last token which isn't a parameter
+            tokens = line.split()
+            model = [_ for _ in tokens if '=' not in _][-1]
+
+            if self.device_prefix in line:
+                devices.append((tokens[0], model, True))
+            else:
+                subcircuits.append((tokens[0], model))
+
+        # devices on this level are listed last to first
+        entries = devices[::-1]
+
+        # then descend into each further subcircuit
+        for refdes, subcircuit in subcircuits:
+            entries.append((refdes, subcircuit, False))
+            if not self.exclude_prefix in subcircuit:
+                for path, model, is_device in self._expand(subcircuit.lower()):
+                    entries.append((refdes + '.' + path, model, is_device))
+
+        self._expanded[scope] = entries
+
+        return entries
+
+
+    def find_model(self, path):
+        '''
+            Return the subcircuit or model instantiated at a hierarchical path
+        '''
+
+        model = self.models.get(path.lower())
+        assert model is not None, 'The instance (%s) cannot be found in the netlist hierarchy' % path
+
+        return model
@@ -1,9 +1,49 @@
 import os, re, subprocess
 import numpy as np
-from spyci import spyci
-from PySpice.Spice.NgSpice.Shared import NgSpiceShared
+from PySpice.Spice.NgSpice.Shared import NgSpiceShared, ffi
 
 from yaaade.spice.generic import GenericSpiceInterface, suppress_stdout_stderr
+from yaaade.spice.parallel import run_process_async
+from yaaade.spice.rawfile import read_raw
+from yaaade.spice.results import SimulationData
+
+
+# names ngspice gives to the scale vector of each analysis
+SCALE_NAMES = ['time', 'frequency', 'v-sweep', 'i-sweep', 'temp-sweep', 'res-sweep']
+
+# number of plots each analysis makes, the noise spectrum is followed by the integrated noise
+ANALYSIS_PLOTS = {'op' : 1, 'dc' : 1, 'ac' : 1, 'tran' : 1, 'tf' : 1, 'sens' : 1, 'pz' : 1, 'disto' : 1, 'noise' : 2}
+
+
+def command_analyses(commands):
+    '''
+        Return the type of each analysis run by a list of control commands
+    '''
+
+    return [_.split()[0].lower() for _ in commands if _.split() and _.split()[0].lower() in ANALYSIS_PLOTS]
+
+
+def plot_offset(analyses, output):
+    '''
+        Return how many plots before the newest one the plot of an output is
+
+        ngspice numbers its plots from a counter which is never reset, not even
+        by destroy all, so a control script cannot name the plots it makes.
+        After the analyses have run the newest plot is the current one and the
+        plot of an output (the first plot of its first analysis) is reached by
+        going back this many times with setplot previous.
+    '''
+
+    offset = 0
+    found = None
+    for analysis in reversed(analyses):
+        plots = ANALYSIS_PLOTS.get(analysis, 0)
+        if analysis == output:
+            found = offset + plots - 1
+        offset += plots
+    assert found is not None, 'No analysis for the output (%s) in %s' % (output, analyses)
+
+    return found
 
 
 class NgSpiceInterface(GenericSpiceInterface):
@@ -20,7 +60,8 @@ class NgSpiceInterface(GenericSpiceInterface):
     
         self.config['simulator'] = {'executable'    :   'ngspice',
                                     'shared'        :   True,
-                                    'silent'        :   False}
+                                    'silent'        :   False,
+                                    'in_memory'     :   True}
         self.config['verbose'] = verbose
 
         # create an ngspice shared object
@@ -57,12 +98,11 @@ class NgSpiceInterface(GenericSpiceInterface):
         for parameter in parameters:
 
             if parameter[1] < 1e-6:
-                sub_string = ".param %s=%0.20f" % (parameter[0], parameter[1])
-                log_information += '%s=%0.20f  ' % (parameter[0], parameter[1])
+                value = "%0.20f" % parameter[1]
             else:
-                sub_string = ".param %s=%f" % (parameter[0], parameter[1])
-                log_information += '%s=%f  ' % (parameter[0], parameter[1])
-            self.simulation['netlist'] = re.sub(r'\.param %s=.*' % parameter[0], sub_string, self.simulation['netlist'])
+                value = "%f" % parameter[1]
+            log_information += '%s=%s  ' % (parameter[0], value)
+            self.simulation['netlist'].set_param(parameter[0], value)
 
         # update user
         if self.config['verbose']:
@@ -78,13 +118,8 @@ class NgSpiceInterface(GenericSpiceInterface):
             print("alterparam temp=%f" % temp)
             self.ngspice.exec_command("alterparam temp=%f" % temp)
 
-        else:
-
-            # change the temperature in the netlist
-            sub_string = ".param temp=%f" % temp
-            self.simulation['netlist'] = re.sub(r'\.param temp=.*', sub_string, self.simulation['netlist'])
-            sub_string = ".temp %f" % temp
-            self.simulation['netlist'] = re.sub(r'\.temp .*', sub_string, self.simulation['netlist'])
+        # change the temperature in the netlist
+        self.simulation['netlist'].set_temperature(temp)
 
         # update user
         if self.config['verbose']:
@@ -92,14 +127,35 @@ class NgSpiceInterface(GenericSpiceInterface):
             print(log_information)
 
 
-    def run_simulation(self, new_instance=True, outputs=None):
+    def simulator_version(self):
+        '''
+            Return the version of ngspice used to key cached results
+        '''
+
+        if 'version' not in self.config['simulator']:
+
+            if self.config['simulator']['shared']:
+                self.config['simulator']['version'] = self.ngspice.ngspice_version
+            else:
+                process = subprocess.Popen(['ngspice', '-v'], stdout=subprocess.PIPE)
+                output, error = process.communicate()
+                self.config['simulator']['version'] = output.decode('utf8', 'replace').strip()
+
+        return self.config['simulator']['version']
+
+
+    def _run_simulation(self, new_instance=True, outputs=None, signals=None):
         '''
             Run simulation
+
+            In shared mode the results are by default copied straight out of the
+            ngspice library rather than through a raw file, optionally limited to
+            the requested signals.
         '''
 
         # write the temporary netlist
-        with open('rundir/spiceinterface_temp.spice', 'w') as f:
-            f.write(self.simulation['netlist'])
+        with open(self.temp_file('.spice'), 'w') as f:
+            f.write(str(self.simulation['netlist']))
 
         # run ngspice
         if self.config['simulator']['shared']:
@@ -111,7 +167,7 @@ class NgSpiceInterface(GenericSpiceInterface):
 
             # load the netlist into the 
             if new_instance:
-                self.ngspice.source('rundir/spiceinterface_temp.spice')
+                self.ngspice.source(self.temp_file('.spice'))
 
             # run the simulation
             if self.config['simulator']['silent']:
@@ -120,23 +176,35 @@ class NgSpiceInterface(GenericSpiceInterface):
             else:
                 self.ngspice.run()
 
-            # save the outputs
-            self.ngspice.exec_command("set filetype=ascii")
-            self.ngspice.exec_command("write rundir/spiceinterface_temp.raw")
+            # transfer the vectors without going through the disk
+            if self.config['simulator']['in_memory']:
+
+                if outputs:
+                    self.simulation_data = {}
+                    for output in outputs:
+                        self.read_shared_results(signals, output, plot_name=self.find_plot(output))
+                else:
+                    self.read_shared_results(signals)
+
+            # save the outputs and read them back
+            else:
+                self.ngspice.exec_command("set filetype=binary")
+                self.ngspice.exec_command("write " + self.temp_file('.raw'))
+                self.read_results(self.temp_file('.raw'))
 
 
         else:
 
-            # set the output format to ascii required by spyci
-            os.environ["SPICE_ASCIIRAWFILE"] = "1"
+            # use the compact binary output format
+            os.environ["SPICE_ASCIIRAWFILE"] = "0"
 
             # run the simulation through command line
-            bash_command = "ngspice -b -r rundir/spiceinterface_temp.raw -o rundir/spiceinterface_temp.out rundir/spiceinterface_temp.spice"
+            bash_command = "ngspice -b -r %s -o %s %s" % (self.temp_file('.raw'), self.temp_file('.out'), self.temp_file('.spice'))
             process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
             output, error = process.communicate()
 
             # check if error occured
-            with open('rundir/spiceinterface_temp.out') as f:
+            with open(self.temp_file('.out')) as f:
                 sim_log = f.read()
                 if 'fatal' in sim_log or 'aborted' in sim_log:
                     print('\033[91m')
@@ -150,9 +218,351 @@ class NgSpiceInterface(GenericSpiceInterface):
             if outputs:
                 self.simulation_data = {}
                 for output in outputs:
-                    self.read_results("rundir/spiceinterface_temp_"+output+".raw", output)
+                    self.read_results(self.temp_file('_' + output + '.raw'), output)
+            else:
+                self.read_results(self.temp_file('.raw'))
+
+
+    async def run_simulation_async(self, outputs=None, netlist=None, rundir=None, timeout=None, log_callback=None):
+        '''
+            Run a batch mode simulation as an asyncio subprocess
+
+            The shared library can't run concurrently so this always uses the
+            ngspice executable. A netlist and run directory can be given so several
+            simulations can be in flight at once, the log is streamed to
+            log_callback line by line. The results are returned and also stored as
+            the current simulation data.
+        '''
+
+        if netlist is None:
+            netlist = self.simulation['netlist']
+
+        # write the temporary netlist
+        with open(self.temp_file('.spice', rundir), 'w') as f:
+            f.write(str(netlist))
+
+        # use the compact binary output format
+        env = dict(os.environ)
+        env["SPICE_ASCIIRAWFILE"] = "0"
+
+        # run the simulation and stream the log
+        command = ['ngspice', '-b', '-r', self.temp_file('.raw', rundir), self.temp_file('.spice', rundir)]
+        sim_log = await run_process_async(command, log_callback=log_callback, timeout=timeout, env=env)
+
+        with open(self.temp_file('.out', rundir), 'w') as f:
+            f.write(sim_log)
+
+        # check if error occured
+        if 'fatal' in sim_log or 'aborted' in sim_log:
+            print('\033[91m')
+            print('-'*150)
+            print('ERROR IN SIMULATION:')
+            print(sim_log)
+            print('-'*150)
+            print('\033[0m')
+
+        # read in the results of the simulation
+        if outputs:
+            simulation_data = {}
+            for output in outputs:
+                simulation_data[output] = self.load_results(self.temp_file('_' + output + '.raw', rundir))
+        else:
+            simulation_data = self.load_results(self.temp_file('.raw', rundir))
+
+        self.simulation_data = simulation_data
+
+        return simulation_data
+
+
+    def find_plot(self, output, exclude=()):
+        '''
+            Find the name of the first plot produced by an analysis type
+
+            ie. 'op' returns 'op1' and 'noise' returns the 'noise1' spectrum plot.
+            Plots in exclude are skipped, ie. the plots which existed before the
+            analysis was run.
+        '''
+
+        # plots are numbered in the order they were created
+        plot_names = [_ for _ in self.ngspice.plot_names if re.match(output + r'\d+$', _) and _ not in exclude]
+        assert len(plot_names) > 0, 'No plot found for the output (%s)' % output
+
+        return min(plot_names, key=lambda _: int(_[len(output):]))
+
+
+    def read_shared_results(self, signals=None, dataset=None, plot_name=None):
+        '''
+            Copy the vectors of a plot straight out of the ngspice shared library
+
+            By default the current plot is read, signals can be provided to only
+            transfer a subset of the vectors.
+        '''
+
+        # default to the most recent plot
+        if plot_name is None:
+            plot_name = self.ngspice.last_plot
+
+        # list all the vectors of the plot
+        if signals is None:
+            names = []
+            all_vectors = self.ngspice._ngspice_shared.ngSpice_AllVecs(plot_name.encode('utf8'))
+            i = 0
+            while all_vectors[i] != ffi.NULL:
+                names.append(ffi.string(all_vectors[i]).decode('utf8').lower())
+                i += 1
+
+            # the scale vector goes first so it can be used as the swept values
+            names = [_ for _ in names if _ in SCALE_NAMES] + [_ for _ in names if _ not in SCALE_NAMES]
+        else:
+            names = [_.lower() for _ in signals]
+
+        # look up each vector in the library
+        vector_info = []
+        for name in names:
+            info = self.ngspice._ngspice_shared.ngGet_Vec_Info((plot_name + '.' + name).encode('utf8'))
+            assert info != ffi.NULL, 'The signal (%s) cannot be found in the plot (%s)' % (name, plot_name)
+            vector_info.append(info)
+
+        # vectors of a different length to the scale belong elsewhere (ie. totals)
+        length = vector_info[0].v_length if vector_info else 0
+        if signals is None:
+            keep = [i for i, info in enumerate(vector_info) if info.v_length == length]
+            names = [names[i] for i in keep]
+            vector_info = [vector_info[i] for i in keep]
+
+        # copy every vector into a single preallocated array
+        complex_data = any([info.v_compdata != ffi.NULL for info in vector_info])
+        values = np.empty((length, len(names)), dtype=np.complex128 if complex_data else np.float64)
+        for i, info in enumerate(vector_info):
+            assert info.v_length == length, 'The signal (%s) has a different length to the other signals' % names[i]
+            if info.v_compdata != ffi.NULL:
+                values[:, i] = np.frombuffer(ffi.buffer(info.v_compdata, length*16), dtype=np.complex128)
             else:
-                self.read_results("rundir/spiceinterface_temp.raw")
+                values[:, i] = np.frombuffer(ffi.buffer(info.v_realdata, length*8), dtype=np.float64)
+
+        simulation_data = SimulationData(values, names)
+
+        # single simulation data or multiple
+        if dataset == None:
+            self.simulation_data = simulation_data
+        else:
+            self.simulation_data[dataset] = simulation_data
+
+
+    def run_batched_sweep(self, parameter, values, outputs=None):
+        '''
+            Run a parameter or temperature sweep in a single ngspice session
+
+            The analyses of the netlist are issued from a control loop which alters
+            the parameter and resets the circuit between points, so the models and
+            circuit setup are only loaded once. An operating point swept over the
+            temperature or a source is run natively as a single dc sweep.
+
+            Returns one dataset per sweep point, keyed by output when there is more
+            than one analysis or outputs are requested.
+        '''
+
+        netlist = self.simulation['netlist'].copy()
+
+        # take the analyses out of the netlist to issue them from the control loop
+        analyses = []
+        for analysis, indices in netlist.analyses.items():
+            for i in indices:
+                analyses.append((i, analysis[1:], netlist.lines[i].strip()[1:]))
+        analyses = [_[1:] for _ in sorted(analyses)]
+        netlist.remove_analyses()
+        netlist.remove_controls()
+
+        flat = outputs is None and len(analyses) == 1
+        if outputs is None:
+            outputs = [_[0] for _ in analyses]
+
+        # a temperature or source sweep of an operating point is native to the dc analysis
+        source = parameter.lower() in netlist.instances[None] and parameter.lower()[0] in 'vi'
+        steps = np.diff(values)
+        native = [_[0] for _ in analyses] == ['op'] and (parameter == 'temp' or source) and len(values) > 1 and np.allclose(steps, steps[0])
+
+        # create the commands run for every point
+        if native:
+            point_commands = ['dc %s %0.12g %0.12g %0.12g' % (parameter, values[0], values[-1], steps[0])]
+        else:
+            assert parameter == 'temp' or parameter.lower() in netlist.params, 'The parameter (%s) is not defined in the netlist' % parameter
+            point_commands = ['destroy all']
+            if parameter.lower() in netlist.params:
+                point_commands += ['alterparam %s = $sweep_value' % parameter]
+            point_commands += ['reset']
+            if parameter == 'temp':
+                point_commands += ['option temp = $sweep_value']
+            point_commands += [_[1] for _ in analyses]
+
+        # the analysis type making the plot of each output
+        plot_types = ['dc'] if native else outputs
+
+        # write the netlist without its analyses
+        with open(self.temp_file('_sweep.spice'), 'w') as f:
+            f.write(str(netlist))
+
+        point_datasets = []
+
+        # drive the loop from python on the loaded shared library
+        if self.config['simulator']['shared']:
+
+            self.ngspice.destroy()
+            self.ngspice.source(self.temp_file('_sweep.spice'))
+
+            for value in (values[:1] if native else values):
+
+                existing = set(self.ngspice.plot_names)
+                for command in point_commands:
+                    command = command.replace('$sweep_value', '%0.12g' % value)
+                    if self.config['simulator']['silent']:
+                        with suppress_stdout_stderr():
+                            self.ngspice.exec_command(command)
+                    else:
+                        self.ngspice.exec_command(command)
+
+                self.simulation_data = {}
+                for output, plot_type in zip(outputs, plot_types):
+                    self.read_shared_results(dataset=output, plot_name=self.find_plot(plot_type, existing))
+                point_datasets.append(self.simulation_data)
+
+        # generate a control script looping over the values and run it once
+        else:
+
+            if os.path.exists(self.temp_file('_sweep.raw')):
+                os.remove(self.temp_file('_sweep.raw'))
+
+            control = ['.control', 'set filetype=binary', 'set appendwrite']
+            if native:
+                control += point_commands
+            else:
+                control += ['foreach sweep_value ' + ' '.join(['%0.12g' % _ for _ in values])]
+                control += ['  ' + _ for _ in point_commands]
+
+            # step back from the newest plot, writing the outputs from the newest to the oldest
+            analysis_types = command_analyses(point_commands)
+            offsets = [plot_offset(analysis_types, _) for _ in plot_types]
+            order = sorted(range(len(outputs)), key=lambda _: offsets[_])
+            position = 0
+            for j in order:
+                control += ['  setplot previous']*(offsets[j] - position) + ['  write ' + self.temp_file('_sweep.raw')]
+                position = offsets[j]
+            if not native:
+                control += ['end']
+            control += ['.endc']
+            netlist.append('\n'.join(control))
+
+            with open(self.temp_file('_sweep.spice'), 'w') as f:
+                f.write(str(netlist))
+
+            bash_command = "ngspice -b -o %s %s" % (self.temp_file('_sweep.out'), self.temp_file('_sweep.spice'))
+            process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
+            output, error = process.communicate()
+
+            # the plots are written point by point, in the order of the offsets
+            raw_plots = read_raw(self.temp_file('_sweep.raw'))
+            for i in range(len(raw_plots)//len(outputs)):
+                point_data = {}
+                for k, j in enumerate(order):
+                    raw_data = raw_plots[i*len(outputs) + k]
+                    point_data[outputs[j]] = SimulationData(raw_data['values'], [_['name'] for _ in raw_data['vars']])
+                point_datasets.append(point_data)
+
+        # split a native sweep into one dataset per point
+        if native:
+            sweep_data = point_datasets[0][outputs[0]]
+            point_datasets = [{outputs[0] : SimulationData(sweep_data.values[i:i+1], sweep_data.names)} for i in range(sweep_data.number_points())]
+
+        if flat:
+            return [_[outputs[0]] for _ in point_datasets]
+        else:
+            return point_datasets
+
+
+    def run_control_steps(self, steps, netlist=None):
+        '''
+            Run a list of analysis steps in a single ngspice session
+
+            Each step is given as (commands, output, signals): the control commands
+            are issued in order and the signals of the plot the output analysis
+            made (ie. 'dc' or 'noise' for the noise spectrum) are then read back.
+            The plots are found rather than named as ngspice keeps numbering them
+            across destroy all. The netlist should not contain analyses of its
+            own, it is only loaded once so the models are not parsed again for
+            every step.
+
+            Returns the simulation data of each step in order.
+        '''
+
+        if netlist is None:
+            netlist = self.simulation['netlist']
+
+        # write the netlist the steps run on
+        with self.stage('write'):
+            with open(self.temp_file('_steps.spice'), 'w') as f:
+                f.write(str(netlist))
+
+        step_datasets = []
+
+        # issue the commands to the loaded shared library
+        if self.config['simulator']['shared']:
+
+            with self.stage('simulate'):
+                self.ngspice.destroy()
+                self.ngspice.source(self.temp_file('_steps.spice'))
+
+            for commands, output, signals in steps:
+
+                with self.stage('simulate'):
+                    existing = set(self.ngspice.plot_names)
+                    for command in commands:
+                        if self.config['simulator']['silent']:
+                            with suppress_stdout_stderr():
+                                self.ngspice.exec_command(command)
+                        else:
+                            self.ngspice.exec_command(command)
+
+                with self.stage('parse'):
+                    self.read_shared_results(signals, plot_name=self.find_plot(output, existing))
+                step_datasets.append(self.simulation_data)
+
+        # write every step to one raw file from a single control block
+        else:
+
+            if os.path.exists(self.temp_file('_steps.raw')):
+                os.remove(self.temp_file('_steps.raw'))
+
+            with self.stage('netlist'):
+                control = ['.control', 'set filetype=binary', 'set appendwrite']
+                for commands, output, signals in steps:
+                    control += commands
+                    control += ['setplot previous']*plot_offset(command_analyses(commands), output)
+                    control += ['write %s %s' % (self.temp_file('_steps.raw'), ' '.join(signals))]
+                control += ['.endc']
+
+                netlist = netlist.copy()
+                netlist.append('\n'.join(control))
+
+            with self.stage('write'):
+                with open(self.temp_file('_steps.spice'), 'w') as f:
+                    f.write(str(netlist))
+
+            with self.stage('simulate'):
+                bash_command = "ngspice -b -o %s %s" % (self.temp_file('_steps.out'), self.temp_file('_steps.spice'))
+                process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
+                output, error = process.communicate()
+
+            # the plots are written in the order of the steps
+            with self.stage('parse'):
+                raw_plots = read_raw(self.temp_file('_steps.raw'))
+                assert len(raw_plots) == len(steps), 'Only %d of the %d steps completed, see %s' % (len(raw_plots), len(steps), self.temp_file('_steps.out'))
+
+                for (commands, output, signals), raw_data in zip(steps, raw_plots):
+                    step_data = SimulationData(raw_data['values'], [_['name'] for _ in raw_data['vars']])
+                    signals = [_.lower() for _ in signals]
+                    step_datasets.append(SimulationData(step_data.columns(signals), signals))
+
+        return step_datasets
 
 
     def set_parameters(self, parameters):
@@ -173,12 +583,11 @@ class NgSpiceInterface(GenericSpiceInterface):
         for parameter in parameters:
 
             if parameter[1] < 1e-6:
-                sub_string = ".param %s=%0.20f" % (parameter[0], parameter[1])
-                log_information += '%s=%0.20f  ' % (parameter[0], parameter[1])
+                value = "%0.20f" % parameter[1]
             else:
-                sub_string = ".param %s=%f" % (parameter[0], parameter[1])
-                log_information += '%s=%f  ' % (parameter[0], parameter[1])
-            self.simulation['netlist'] = re.sub(r'\.param %s=.*' % parameter[0], sub_string, self.simulation['netlist'])
+                value = "%f" % parameter[1]
+            log_information += '%s=%s  ' % (parameter[0], value)
+            self.simulation['netlist'].set_param(parameter[0], value)
 
         # update user
         if self.config['verbose']:
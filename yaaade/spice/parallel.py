@@ -0,0 +1,148 @@
+import os
+import copy
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from yaaade.spice.generic import GenericSpiceInterface
+
+
+def _run_job(interface_class, verbose, config, simulation, job, signals):
+    '''
+        Run a single simulation job inside a worker process
+
+        A fresh interface object is built for every job so no simulator state
+        leaks between jobs, and the run directory is made unique to the worker
+        process so the temporary netlist and raw files never collide.
+    '''
+
+    # recreate the interface inside this process
+    interface = interface_class(verbose=verbose)
+    interface.config.update(copy.deepcopy(config))
+    interface.simulation = copy.deepcopy(simulation)
+
+    # isolate the temporary files of this worker
+    interface.config['rundir'] = os.path.join(config['rundir'], 'worker_%d' % os.getpid())
+
+    # apply the changes for this job directly to the netlist
+    if 'temperature' in job:
+        GenericSpiceInterface.set_temperature(interface, job['temperature'])
+    if 'parameters' in job:
+        interface.set_parameters(job['parameters'])
+    if 'seed' in job:
+        interface.set_seed(job['seed'])
+
+    # run the simulation
+    interface.run_simulation(outputs=job.get('outputs'))
+
+    # return everything or only the requested signals
+    if signals is None:
+        return interface.simulation_data
+    else:
+        return {signal : interface.get_signal(signal) for signal in signals}
+
+
+
+def run_parallel(interface, jobs, signals=None, workers=None):
+    '''
+        Run independent simulation jobs across a pool of worker processes
+
+        Each job is a dictionary with any of the keys:
+            temperature     :   simulation temperature
+            parameters      :   list of [name, value] netlist parameters
+            seed            :   random seed for Monte-Carlo variation
+            outputs         :   list of output datasets to read back
+
+        The results are returned as a list in the same order as the jobs, either
+        the full simulation data or a dictionary of the requested signals.
+    '''
+
+    # default to one worker per core
+    if not workers:
+        workers = os.cpu_count()
+
+    # the shared simulator library is not fork safe so always spawn fresh processes
+    context = multiprocessing.get_context('spawn')
+
+    # dispatch the jobs, map preserves the ordering of the results
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        results = executor.map(_run_job,
+                                [type(interface)]*len(jobs),
+                                [interface.config['verbose']]*len(jobs),
+                                [interface.config]*len(jobs),
+                                [interface.simulation]*len(jobs),
+                                jobs,
+                                [signals]*len(jobs))
+
+        return list(results)
+
+
+
+async def run_process_async(command, log_callback=None, timeout=None, env=None):
+    '''
+        Run a simulator subprocess from an asyncio event loop
+
+        The combined stdout/stderr is streamed line by line to log_callback as it
+        is produced and also returned as a single string. The process is killed if
+        the timeout expires or the calling task is cancelled.
+    '''
+
+    process = await asyncio.create_subprocess_exec(*command,
+                                                    stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.STDOUT,
+                                                    env=env)
+
+    async def stream_log():
+        log = []
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            line = line.decode('utf8', 'replace')
+            log.append(line)
+            if log_callback:
+                log_callback(line.rstrip('\n'))
+        await process.wait()
+        return ''.join(log)
+
+    try:
+        return await asyncio.wait_for(stream_log(), timeout)
+
+    finally:
+
+        # make sure nothing is left running on timeout or cancellation
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+
+async def gather_simulations(interface, netlists, outputs=None, concurrency=8, timeout=None,
+                                log_callback=None, return_exceptions=False):
+    '''
+        Run many batch simulations concurrently from one event loop
+
+        Each netlist is simulated through interface.run_simulation_async in its own
+        run directory, with at most concurrency simulators running at once. The
+        log callback is given the index of the netlist along with each log line.
+        The results are returned in the same order as the netlists.
+    '''
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_job(i, netlist):
+
+        if log_callback:
+            job_log_callback = lambda line: log_callback(i, line)
+        else:
+            job_log_callback = None
+
+        async with semaphore:
+            return await interface.run_simulation_async(outputs=outputs,
+                                                        netlist=netlist,
+                                                        rundir=os.path.join(interface.config['rundir'], 'job_%d' % i),
+                                                        timeout=timeout,
+                                                        log_callback=job_log_callback)
+
+    return await asyncio.gather(*[run_job(i, netlist) for i, netlist in enumerate(netlists)],
+                                return_exceptions=return_exceptions)
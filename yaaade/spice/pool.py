@@ -0,0 +1,176 @@
+import os
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from yaaade.spice.netlist import Netlist
+from yaaade.spice.generic import suppress_stdout_stderr
+
+
+# state of the simulator held by each worker process
+_worker = {}
+
+
+def _init_worker(silent):
+    '''
+        Create the shared ngspice instance of a worker process
+    '''
+
+    from yaaade.spice.ngspice import NgSpiceInterface
+
+    _worker['interface'] = NgSpiceInterface(verbose=False)
+    _worker['interface'].config['simulator']['silent'] = silent
+    _worker['key'] = None
+    _worker['params'] = {}
+
+
+
+def _call(function, *args):
+    '''
+        Call the worker's simulator, silencing it if requested
+    '''
+
+    if _worker['interface'].config['simulator']['silent']:
+        with suppress_stdout_stderr():
+            return function(*args)
+    else:
+        return function(*args)
+
+
+
+def _run_warm_job(key, path, parameters, signals, outputs):
+    '''
+        Run a job on the circuit already loaded in this worker
+
+        The circuit is only sourced again when the topology has changed, otherwise
+        the parameters that differ from the loaded values are altered in place.
+    '''
+
+    interface = _worker['interface']
+
+    # load a new topology along with its models
+    if _worker['key'] != key:
+        interface.ngspice.destroy()
+        if _worker['key'] is not None:
+            _call(interface.ngspice.exec_command, 'remcirc')
+        _call(interface.ngspice.source, path)
+
+        netlist = Netlist(open(path).read())
+        _worker['params'] = {name : netlist.get_param(name) for name in netlist.params}
+        _worker['key'] = key
+
+    # only send the parameters which have changed since the last job
+    delta = [[name, value] for name, value in parameters.items() if _worker['params'].get(name) != value]
+    for name, value in delta:
+        _call(interface.ngspice.exec_command, 'alterparam %s=%s' % (name, value))
+        _worker['params'][name] = value
+    if delta:
+        _call(interface.ngspice.exec_command, 'reset')
+
+    # run the simulation
+    interface.ngspice.destroy()
+    _call(interface.ngspice.run)
+
+    # copy the results out of the library
+    if outputs:
+        interface.simulation_data = {}
+        for output in outputs:
+            interface.read_shared_results(signals, output, plot_name=interface.find_plot(output))
+    else:
+        interface.read_shared_results(signals)
+
+    return interface.simulation_data
+
+
+
+class NgSpiceWorkerPool():
+    '''
+        Pool of long-lived processes each holding a loaded shared ngspice instance
+
+        Jobs are given as a netlist plus parameter changes. The netlist is reduced
+        to its topology (the text without the .param values) so jobs sharing a
+        topology reuse the circuit and models already loaded in a worker, only
+        having the changed parameters applied with alterparam before the run.
+    '''
+
+    def __init__(self, workers=None, rundir='rundir/pool', silent=True):
+        '''
+            Start the worker processes
+        '''
+
+        if not workers:
+            workers = os.cpu_count()
+
+        self.rundir = rundir
+        if not os.path.exists(self.rundir):
+            os.makedirs(self.rundir, exist_ok=True)
+
+        # the shared simulator library is not fork safe so always spawn fresh processes
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker,
+                                            initargs=(silent,))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *_):
+        self.close()
+
+
+    def close(self):
+        '''
+            Stop the worker processes
+        '''
+
+        self.executor.shutdown()
+
+
+    def topology(self, netlist):
+        '''
+            Return the key of the netlist topology and the file the workers load
+        '''
+
+        # blank out the parameter values so they don't change the key
+        param_lines = set(netlist.params.values())
+        lines = [_ for i, _ in enumerate(netlist.lines) if _ is not None and i not in param_lines]
+        key = hashlib.sha256('\n'.join(lines).encode('utf8')).hexdigest()
+
+        # the first netlist seen with this topology is the one loaded
+        path = os.path.join(self.rundir, key + '.spice')
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'w') as f:
+                f.write(str(netlist))
+            os.replace(path + '.tmp', path)
+
+        return key, path
+
+
+    def submit(self, netlist, parameters=None, signals=None, outputs=None):
+        '''
+            Queue a simulation and return a future of its simulation data
+
+            Parameters are passed as [['vds', 1.8], ['vbs', 0.2]] and override the
+            values in the netlist.
+        '''
+
+        key, path = self.topology(netlist)
+
+        # the full set of parameter values wanted for this job
+        values = {name : netlist.get_param(name) for name in netlist.params}
+        for name, value in (parameters or []):
+            values[name.lower()] = '%0.20g' % value
+
+        return self.executor.submit(_run_warm_job, key, path, values, signals, outputs)
+
+
+    def map(self, netlist, parameter_sets, signals=None, outputs=None):
+        '''
+            Run the netlist for each set of parameters and return the results in order
+        '''
+
+        futures = [self.submit(netlist, parameters, signals, outputs) for parameters in parameter_sets]
+
+        return [_.result() for _ in futures]
@@ -0,0 +1,129 @@
+import os
+import re
+import numpy as np
+
+
+def _read_header(f):
+    '''
+        Read the header of a single plot leaving the file positioned at the data
+    '''
+
+    header = {'vars' : []}
+
+    while True:
+
+        line = f.readline()
+
+        # end of the file reached before a plot started
+        if not line:
+            return None
+
+        line = line.decode('ascii', 'replace').strip()
+        if not line:
+            continue
+
+        key, _, value = line.partition(':')
+        key = key.strip().lower()
+        value = value.strip()
+
+        # the variables are listed one per line after the keyword
+        if key == 'variables':
+            for i in range(header['no. variables']):
+                fields = f.readline().decode('ascii', 'replace').split()
+                header['vars'].append({'idx' : int(fields[0]), 'name' : fields[1].lower(), 'type' : fields[2]})
+
+        # the data block follows directly
+        elif key in ['binary', 'values']:
+            header['format'] = key
+            return header
+
+        elif key in ['no. variables', 'no. points']:
+            header[key] = int(value)
+
+        else:
+            header[key] = value
+
+
+
+def _read_ascii_values(f, header, number_columns):
+    '''
+        Read an ASCII data block, stopping at the start of the next plot
+    '''
+
+    # gather all the lines of the data block
+    lines = []
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line:
+            break
+        if line.startswith(b'Title:'):
+            f.seek(position)
+            break
+        lines.append(line)
+
+    # each point is the point index followed by the values of every variable
+    tokens = re.split(r'[\s,]+', b''.join(lines).decode('ascii').strip())
+    values = np.array(tokens, dtype=np.float64).reshape(header['no. points'], 1 + number_columns)[:, 1:]
+
+    if 'complex' in header['flags']:
+        values = values.view(np.complex128)
+
+    return np.ascontiguousarray(values)
+
+
+
+def read_raw(path, mmap=False):
+    '''
+        Read every plot of an ngspice raw file
+
+        Binary data blocks are read straight into NumPy arrays of shape (points,
+        variables), ASCII blocks are parsed in a single vectorised pass. With
+        mmap the binary blocks are memory mapped instead of copied, only use
+        this for files which are not rewritten while the arrays are in use (the
+        temporary raw files of the simulator interfaces are rewritten by every
+        run).
+        Each plot is returned as a dictionary with the header fields, the list of
+        variables under 'vars' and the data array under 'values'.
+    '''
+
+    plots = []
+    file_size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        while f.tell() < file_size:
+
+            # parse the plot header
+            header = _read_header(f)
+            if header is None:
+                break
+
+            number_points = header['no. points']
+            number_variables = header['no. variables']
+            complex_data = 'complex' in header.get('flags', 'real')
+            header['flags'] = header.get('flags', 'real')
+
+            # read or map the binary block, or parse the text block
+            if header['format'] == 'binary':
+
+                dtype = np.dtype('<c16') if complex_data else np.dtype('<f8')
+                offset = f.tell()
+
+                if number_points == 0:
+                    values = np.zeros((0, number_variables), dtype=dtype)
+                elif mmap:
+                    values = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(number_points, number_variables))
+                else:
+                    values = np.fromfile(f, dtype=dtype, count=number_points*number_variables).reshape(number_points, number_variables)
+
+                # move on to the next plot
+                f.seek(offset + number_points*number_variables*dtype.itemsize)
+
+            else:
+                number_columns = number_variables*2 if complex_data else number_variables
+                values = _read_ascii_values(f, header, number_columns)
+
+            header['values'] = values
+            plots.append(header)
+
+    return plots
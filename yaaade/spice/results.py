@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class SimulationData():
+    '''
+        Columnar store for the results of a single simulation dataset
+
+        All the signals are held in one 2-D array (points x variables) with a
+        lookup from signal name to column. Signals are returned as views of that
+        array so no per-point Python work is done when reading them back.
+    '''
+
+    def __init__(self, values, names):
+        '''
+            Wrap an existing (points x variables) array
+        '''
+
+        self.values = values
+        self.names = list(names)
+        self.index = {name : i for i, name in enumerate(self.names)}
+
+
+    @classmethod
+    def from_dict(cls, signals):
+        '''
+            Build the store from a dictionary of equal length signals
+        '''
+
+        names = list(signals.keys())
+        values = np.column_stack([np.atleast_1d(signals[name]) for name in names]) if names else np.zeros((0, 0))
+
+        return cls(values, names)
+
+
+    def __getitem__(self, name):
+        return self.values[:, self.index[name]]
+
+
+    def __contains__(self, name):
+        return name in self.index
+
+
+    def __iter__(self):
+        return iter(self.names)
+
+
+    def __len__(self):
+        return len(self.names)
+
+
+    def keys(self):
+        return list(self.names)
+
+
+    def items(self):
+        return [(name, self[name]) for name in self.names]
+
+
+    def number_points(self):
+        '''
+            Return the number of points in each signal
+        '''
+
+        return self.values.shape[0]
+
+
+    def columns(self, names):
+        '''
+            Return several signals as one (points x signals) array
+        '''
+
+        return self.values[:, [self.index[name] for name in names]]
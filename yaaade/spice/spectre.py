@@ -1,8 +1,16 @@
+import os
 import re
 import subprocess
 import libpsf
 
 from yaaade.spice.generic import GenericSpiceInterface
+from yaaade.spice.parallel import run_process_async
+from yaaade.spice.results import SimulationData
+
+
+# PSF files of the outputs which aren't named after their file
+PSF_FILES = {'op' : 'dcOp.dc', 'noise' : 'noise.noise'}
+PSF_OUTPUTS = {file : output for output, file in PSF_FILES.items()}
 
 class SpectreInterface(GenericSpiceInterface):
     '''
@@ -28,40 +36,47 @@ class SpectreInterface(GenericSpiceInterface):
             Extract all the simulation results
         '''
 
-        sim_data = libpsf.PSFDataSet( 'spiceinterface_temp.raw/' + output )
+        sim_data = libpsf.PSFDataSet( self.temp_file('.raw/') + output )
         signal_names = sim_data.get_signal_names()
 
 
-    def run_simulation(self, new_instance=True, outputs=None):
+    def simulator_version(self):
         '''
-            Run simulation
+            Return the version of spectre used to key cached results
         '''
 
-        # write the temporary netlist
-        with open('spiceinterface_temp.spice', 'w') as f:
-            f.write(self.simulation['netlist'])
+        if 'version' not in self.config['simulator']:
+            process = subprocess.Popen(['spectre', '-V'], stdout=subprocess.PIPE)
+            output, error = process.communicate()
+            self.config['simulator']['version'] = output.decode('utf8', 'replace').strip()
 
+        return self.config['simulator']['version']
 
-        # run the simulation through command line
-        # bash_command = "spectre -format nutascii spiceinterface_temp.spice"
-        # bash_command = "spectre -format psfascii spiceinterface_temp.spice"
-        bash_command = "spectre spiceinterface_temp.spice"
-        process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
-        output, error = process.communicate()
 
+    def read_psf_results(self, outputs, rundir=None):
+        '''
+            Read the PSF results of each output into a dictionary of datasets
 
-        self.simulation_data = {}
-        for output in outputs:
+            Without outputs every analysis result in the raw directory is read.
+        '''
+
+        # every analysis result by default, skipping the log and info files
+        if outputs is None:
+            outputs = []
+            for name in sorted(os.listdir(self.temp_file('.raw', rundir))):
+                parts = name.split('.')
+                if len(parts) == 2 and parts[1] != 'info':
+                    outputs.append(PSF_OUTPUTS.get(name, name))
 
-            if output == 'op':
-                sim_data = libpsf.PSFDataSet( 'spiceinterface_temp.raw/dcOp.dc')
+        simulation_data = {}
+        for output in outputs:
 
-            elif output == 'noise':
-                sim_data = libpsf.PSFDataSet( 'spiceinterface_temp.raw/noise.noise')
+            if output in PSF_FILES:
+                sim_data = libpsf.PSFDataSet( self.temp_file('.raw/' + PSF_FILES[output], rundir) )
             else:
-                sim_data = libpsf.PSFDataSet( 'spiceinterface_temp.raw/' + output )
+                sim_data = libpsf.PSFDataSet( self.temp_file('.raw/', rundir) + output )
 
-            self.simulation_data[output] = {}
+            simulation_data[output] = {}
 
             for signal in sim_data.get_signal_names():
                 signal_shortened = signal.split(':')[-1]
@@ -69,7 +84,7 @@ class SpectreInterface(GenericSpiceInterface):
                 if output == 'noise' and signal_shortened == 'out':
                     signal_shortened = 'onoise_spectrum'
 
-                self.simulation_data[output][signal_shortened] = sim_data.get_signal(signal)
+                simulation_data[output][signal_shortened] = sim_data.get_signal(signal)
 
 
             if sim_data.is_swept():
@@ -79,8 +94,59 @@ class SpectreInterface(GenericSpiceInterface):
                 if sweep_variable == 'freq':
                     sweep_variable = 'frequency'
 
-                self.simulation_data[output][sweep_variable] = sim_data.get_sweep_values()
+                simulation_data[output][sweep_variable] = sim_data.get_sweep_values()
+
+            # store the signals as a single array
+            simulation_data[output] = SimulationData.from_dict(simulation_data[output])
+
+        return simulation_data
+
+
+    async def run_simulation_async(self, outputs=None, netlist=None, rundir=None, timeout=None, log_callback=None):
+        '''
+            Run the simulation as an asyncio subprocess
+
+            A netlist and run directory can be given so several simulations can be
+            in flight at once, the log is streamed to log_callback line by line.
+            The results are returned and also stored as the current simulation data.
+        '''
+
+        if netlist is None:
+            netlist = self.simulation['netlist']
+
+        # write the temporary netlist
+        with open(self.temp_file('.spice', rundir), 'w') as f:
+            f.write(str(netlist))
+
+        # run the simulation and stream the log
+        command = ['spectre', self.temp_file('.spice', rundir), '-raw', self.temp_file('.raw', rundir)]
+        await run_process_async(command, log_callback=log_callback, timeout=timeout)
+
+        simulation_data = self.read_psf_results(outputs, rundir)
+        self.simulation_data = simulation_data
+
+        return simulation_data
+
+
+    def _run_simulation(self, new_instance=True, outputs=None):
+        '''
+            Run simulation
+        '''
+
+        # write the temporary netlist
+        with open(self.temp_file('.spice'), 'w') as f:
+            f.write(str(self.simulation['netlist']))
+
+
+        # run the simulation through command line
+        # bash_command = "spectre -format nutascii spiceinterface_temp.spice"
+        # bash_command = "spectre -format psfascii spiceinterface_temp.spice"
+        bash_command = "spectre %s -raw %s" % (self.temp_file('.spice'), self.temp_file('.raw'))
+        process = subprocess.Popen(bash_command.split(), stdout=subprocess.PIPE)
+        output, error = process.communicate()
+
 
+        self.simulation_data = self.read_psf_results(outputs)
 
 
 
@@ -119,12 +185,11 @@ class SpectreInterface(GenericSpiceInterface):
         for parameter in parameters:
 
             if parameter[1] < 1e-6:
-                sub_string = "\\1%s=%0.20f\\2" % (parameter[0], parameter[1])
-                log_information += '%s=%0.20f  ' % (parameter[0], parameter[1])
+                value = "%0.20f" % parameter[1]
             else:
-                sub_string = "\\1%s=%f\\2" % (parameter[0], parameter[1])
-                log_information += '%s=%f  ' % (parameter[0], parameter[1])
-            self.simulation['netlist'] = re.sub(r'(parameters.+)%s=\S+(.*)' % parameter[0], sub_string, self.simulation['netlist'])
+                value = "%f" % parameter[1]
+            log_information += '%s=%s  ' % (parameter[0], value)
+            self.simulation['netlist'].set_param(parameter[0], value)
 
         # update user
         if self.config['verbose']:
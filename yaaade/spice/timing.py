@@ -0,0 +1,90 @@
+import time
+import contextlib
+
+
+class StageTimer():
+    '''
+        Accumulates the wall clock time spent in each named stage of a run
+
+        Stages are timed with the stage() context manager and may nest, in which
+        case the time of the inner stage is also counted in the outer one. The
+        totals and the number of times each stage was entered are kept until
+        reset() is called.
+    '''
+
+    def __init__(self):
+        '''
+            Start with no stages recorded
+        '''
+
+        self.seconds = {}
+        self.calls = {}
+
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''
+            Time the body of a with block as the named stage
+        '''
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+    def add(self, name, seconds, calls=1):
+        '''
+            Add time measured elsewhere to a stage
+        '''
+
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+
+    def reset(self):
+        '''
+            Forget every stage recorded so far
+        '''
+
+        self.seconds = {}
+        self.calls = {}
+
+
+    def merge(self, other):
+        '''
+            Add the stages recorded by another timer, ie. from a worker process
+        '''
+
+        for name in other.seconds:
+            self.add(name, other.seconds[name], other.calls[name])
+
+
+    def report(self, total=None):
+        '''
+            Return the seconds, calls and fraction of the total of each stage
+
+            The total defaults to the sum of the stages.
+        '''
+
+        if total is None:
+            total = sum(self.seconds.values())
+
+        return {name : {'seconds'   :   self.seconds[name],
+                        'calls'     :   self.calls[name],
+                        'fraction'  :   self.seconds[name]/total if total else 0.0} for name in self.seconds}
+
+
+    def summary(self, total=None):
+        '''
+            Return the stages as a table sorted by the time spent
+        '''
+
+        report = self.report(total)
+
+        lines = ['%-16s %12s %10s %8s' % ('stage', 'seconds', 'calls', '%')]
+        for name in sorted(report, key=lambda _: -report[_]['seconds']):
+            lines.append('%-16s %12.4f %10d %8.1f' % (name, report[name]['seconds'], report[name]['calls'], 100*report[name]['fraction']))
+
+        return '\n'.join(lines)